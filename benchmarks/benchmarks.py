@@ -0,0 +1,109 @@
+"""Benchmarks of idpy hot paths.
+
+Every benchmark is a function returning a tuple (work, unit, run) where
+'run' is a callable performing 'work' units of work, so that the runner
+can report rates such as points/s, particles/s and cells/s. Benchmarks
+that write files are context managers yielding that tuple, and remove
+their temporary directory on exit.
+"""
+
+import contextlib
+import os
+import tempfile
+import numpy
+import idpy
+import geometries
+
+
+def _line(magnet, nr_pts, x=0.0, y=0.0):
+    pos = numpy.zeros((nr_pts, 3))
+    pos[:,0], pos[:,1] = x, y
+    pos[:,2] = numpy.linspace(magnet.zmin - 0.1, magnet.zmax + 0.1, nr_pts)
+    return pos
+
+def _field(geometry, nr_pts=20000):
+    magnet = geometries.GEOMETRIES[geometry]()
+    pos = _line(magnet, nr_pts, 0.001, 0.001)
+    return nr_pts, 'points', lambda: magnet.field(pos)
+
+def field_halbach_cassette():
+    return _field('halbach_cassette')
+
+def field_epu():
+    return _field('epu')
+
+def field_delta():
+    return _field('delta')
+
+@contextlib.contextmanager
+def fieldmap_field(nr_pts=200000):
+    magnet = geometries.epu()
+    x = numpy.linspace(-0.005, 0.005, 11)
+    y = numpy.linspace(-0.002, 0.002, 5)
+    z = numpy.linspace(magnet.zmin - 0.1, magnet.zmax + 0.1, 501)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'epu.npy')
+        idpy.fieldmap.export_fieldmap(magnet, filename, x, y, z)
+        fieldmap = idpy.fieldmap.FieldMap('epu', filename)
+        pos = numpy.random.RandomState(0).uniform([x[0], y[0], z[0]], [x[-1], y[-1], z[-1]], (nr_pts, 3))
+        yield nr_pts, 'points', lambda: fieldmap.field(pos)
+
+def runge_kutta(nr_particles=20):
+    magnet = geometries.epu()
+    R = numpy.zeros((nr_particles, 3))
+    R[:,0] = numpy.linspace(-0.005, 0.005, nr_particles)
+    R[:,2] = magnet.zmin - 0.1
+    P = numpy.tile([0.0, 0.0, 1.0], (nr_particles, 1))
+    zmax = magnet.zmax + 0.1
+    return nr_particles, 'particles', lambda: idpy.functions.runge_kutta_batch(magnet, 3e9, R, P, zmax, 0.001)
+
+def calc_kickmap(nx=5, ny=3):
+    magnet = geometries.epu()
+    grid = idpy.auxiliary.Grid(nx, ny, -0.005, 0.005, -0.002, 0.002)
+    zmin, zmax = magnet.zmin - 0.1, magnet.zmax + 0.1
+    return nx*ny, 'cells', lambda: idpy.functions.calc_kickmap(magnet, 3e9, grid, zmin, zmax, 0.001)
+
+def utils_converters(nr_vectors=100000):
+    matrix = numpy.random.RandomState(0).rand(nr_vectors, 3)
+    def run():
+        cpp = idpy.utils._matrix_to_CppVectorVector3D(matrix)
+        idpy.utils._CppVectorVector3D_to_matrix(cpp)
+    return nr_vectors, 'vectors', run
+
+def _kickmap(nx=201, ny=101):
+    x = numpy.linspace(-0.012, 0.012, nx)
+    y = numpy.linspace(-0.004, 0.004, ny)
+    kick = numpy.outer(y, x)
+    return idpy.auxiliary.KickMap(2.0, x, y, kick, kick)
+
+@contextlib.contextmanager
+def kickmap_text_io():
+    kickmap = _kickmap()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'kickmap.txt')
+        def run():
+            kickmap.write_to_file(filename)
+            idpy.auxiliary.KickMap.read_from_file(filename)
+        yield len(kickmap.x)*len(kickmap.y), 'cells', run
+
+@contextlib.contextmanager
+def kickmap_binary_io():
+    kickmap = _kickmap()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'kickmap.kmap')
+        def run():
+            kickmap.save(filename)
+            numpy.asarray(idpy.auxiliary.KickMap.load(filename).kick_x).sum()
+        yield len(kickmap.x)*len(kickmap.y), 'cells', run
+
+BENCHMARKS = [
+    field_halbach_cassette,
+    field_epu,
+    field_delta,
+    fieldmap_field,
+    runge_kutta,
+    calc_kickmap,
+    utils_converters,
+    kickmap_text_io,
+    kickmap_binary_io,
+]
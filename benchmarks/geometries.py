@@ -0,0 +1,27 @@
+"""Reference geometries of the test notebooks used by the benchmarks."""
+
+import idpy
+
+
+def halbach_cassette():
+    # test/notebooks/Halbach_cassete_idpy.ipynb
+    block = idpy.cassette.Block([0, 1, 0], [0.06, 0.06, 0.06], [0, 0, 0])
+    return idpy.cassette.HalbachCassette(block, idpy.utils.rotx90p, 3, spacing=0, N=4)
+
+def epu():
+    # test/notebooks/epu.ipynb
+    period_length = 0.040
+    block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, period_length/4], [0, 0, 0])
+    return idpy.idmodel.EPU(block, 20, 0.020, 0)
+
+def delta():
+    # same blocks and number of periods as the EPU of test/notebooks/epu.ipynb
+    period_length = 0.040
+    block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, period_length/4], [0, 0, 0])
+    return idpy.idmodel.DELTA(block, 20, 0.020, 0.020)
+
+GEOMETRIES = {
+    'halbach_cassette': halbach_cassette,
+    'epu': epu,
+    'delta': delta,
+}
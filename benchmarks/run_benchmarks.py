@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Runs the idpy benchmarks and appends the results to a JSON history file.
+
+    ./run_benchmarks.py [-r REPEAT] [-o OUTPUT] [name ...]
+
+Each run is stored with the idpy version, git commit and host name, and
+the rate of every benchmark is printed next to the one of the previous
+run recorded in the history.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import idpy
+import benchmarks
+
+
+def git_commit():
+    try:
+        path = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=path).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(benchmark, repeat):
+    setup = benchmark()
+    if not hasattr(setup, '__enter__'):
+        setup = contextlib.nullcontext(setup)
+    with setup as (work, unit, run):
+        run()
+        times = []
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t0)
+    return {'work': work, 'unit': unit, 'time': min(times), 'rate': work/min(times)}
+
+def load_history(filename):
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def previous_rate(history, name):
+    for run in reversed(history):
+        if name in run['results']:
+            return run['results'][name]['rate']
+    return None
+
+def main():
+    default_output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json')
+    parser = argparse.ArgumentParser(description='Run idpy benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timed repetitions')
+    parser.add_argument('-o', '--output', default=default_output, help='JSON history file')
+    args = parser.parse_args()
+
+    selected = [b for b in benchmarks.BENCHMARKS if not args.names or b.__name__ in args.names]
+    history = load_history(args.output)
+    results = {}
+    for benchmark in selected:
+        name = benchmark.__name__
+        result = run_benchmark(benchmark, args.repeat)
+        results[name] = result
+        previous = previous_rate(history, name)
+        change = '' if previous is None else '{0:+.1f}%'.format(100*(result['rate']/previous - 1))
+        print('{0:<24s} {1:>14.4g} {2:<12s} {3:>8s}'.format(name, result['rate'], result['unit'] + '/s', change))
+        sys.stdout.flush()
+
+    history.append({
+        'version': idpy.__version__,
+        'commit': git_commit(),
+        'host': platform.node(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    })
+    with open(args.output, 'w') as f:
+        json.dump(history, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
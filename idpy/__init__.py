@@ -1,10 +1,13 @@
 
+from . import profiling
 from . import utils
 from . import auxiliary
 from . import fieldmap
 from . import cassette
 from . import idmodel
 from . import functions
+from . import sorting
+from .profiling import profile
 
 import os as _os
 with open(_os.path.join(__path__[0], 'VERSION'), 'r') as _f:
@@ -1,20 +1,135 @@
 
+import json as _json
+import os as _os
+import struct as _struct
+import time as _time
 import numpy as _numpy
 import idcpp as _idcpp
 import idpy.utils as _utils
+import idpy.profiling as _profiling
+
+
+_KICKMAP_MAGIC = b'IDPYKMAP'
+_KICKMAP_VERSION = 1
+_KICKMAP_ALIGNMENT = 64
+
+# Electron rest energy divided by c [T.m]
+_ELECTRON_RIGIDITY = 0.51099895e6/299792458.0
+
+
+def _cumulative_integral(f, dz, method='trapezoid'):
+    # Cumulative integral of f along axis -2 on a uniform grid.
+    integral = _numpy.zeros(f.shape)
+    if method == 'trapezoid' or f.shape[-2] < 3:
+        increments = (f[...,1:,:] + f[...,:-1,:])*(dz/2.0)
+    elif method == 'simpson':
+        # Integral over each interval of the parabola through three nodes
+        increments = _numpy.empty(f.shape[:-2] + (f.shape[-2] - 1, f.shape[-1]))
+        increments[...,:-1,:] = (5*f[...,:-2,:] + 8*f[...,1:-1,:] - f[...,2:,:])*(dz/12.0)
+        increments[...,-1,:] = (-f[...,-3,:] + 8*f[...,-2,:] + 5*f[...,-1,:])*(dz/12.0)
+    else:
+        raise Exception("Invalid integration method")
+    _numpy.cumsum(increments, axis=-2, out=integral[...,1:,:])
+    return integral
+
+def _field_integrals(field_function, x, y, zmin, zmax, nrpts, method='trapezoid', cumulative=False, chunk_size=1000000):
+    x, y = _numpy.broadcast_arrays(_numpy.asarray(x, dtype=float), _numpy.asarray(y, dtype=float))
+    shape = x.shape
+    x, y = x.ravel(), y.ravel()
+    z = _numpy.linspace(zmin, zmax, nrpts)
+    dz = z[1] - z[0]
+    out_shape = (len(x), nrpts, 3) if cumulative else (len(x), 3)
+    first, second = _numpy.empty(out_shape), _numpy.empty(out_shape)
+    # transverse points are evaluated together, in chunks of bounded memory
+    nr_lines = max(1, chunk_size//nrpts)
+    for i in range(0, len(x), nr_lines):
+        sel = slice(i, i + nr_lines)
+        nr = len(x[sel])
+        pos = _numpy.empty((nr, nrpts, 3))
+        pos[:,:,0] = x[sel,None]
+        pos[:,:,1] = y[sel,None]
+        pos[:,:,2] = z
+        field = _numpy.reshape(field_function(pos.reshape(-1,3)), (nr, nrpts, 3))
+        i1 = _cumulative_integral(field, dz, method)
+        i2 = _cumulative_integral(i1, dz, method)
+        if cumulative:
+            first[sel], second[sel] = i1, i2
+        else:
+            first[sel], second[sel] = i1[:,-1], i2[:,-1]
+    first = first.reshape(shape + out_shape[1:])
+    second = second.reshape(shape + out_shape[1:])
+    return (z, first, second) if cumulative else (first, second)
+
+def _field_rows(state, bounds):
+    start_time = _time.perf_counter()
+    field_function, positions = state
+    start, stop = bounds
+    field = _numpy.atleast_2d(field_function(positions[start:stop]))
+    return field, _profiling.worker_stats(start_time, points=stop - start)
+
+def _parallel_field(field_function, pos, workers, min_chunk_size=4096):
+    # idcpp holds the GIL during field evaluation, so the chunks are
+    # evaluated in forked processes and gathered into one output array.
+    positions = _numpy.ascontiguousarray(pos, dtype=_numpy.float64)
+    nr_chunks = max(1, min(4*workers, len(positions)//min_chunk_size))
+    bounds = _numpy.linspace(0, len(positions), nr_chunks + 1).astype(int)
+    chunks = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+    results = _utils._fork_map(_field_rows, (field_function, positions), chunks, workers)
+    field = _numpy.empty(positions.shape)
+    for (start, stop), (result, stats) in zip(chunks, results):
+        field[start:stop] = result
+        _profiling.add_worker_stats(stats)
+    return field
+
+def _phase_error(field_function, x, y, zmin, zmax, period, nrpts_per_period=100, skip_periods=2):
+    margin = 2*period
+    nrpts = int(round((zmax - zmin + 2*margin)/period*nrpts_per_period)) + 1
+    z, first, second = _field_integrals(field_function, x, y, zmin - margin, zmax + margin, nrpts, 'simpson', True)
+
+    # gamma times the horizontal and vertical angles of the trajectory
+    central = (z >= zmin + skip_periods*period) & (z <= zmax - skip_periods*period)
+    if _numpy.sum(central) < nrpts_per_period:
+        raise Exception("Magnet too short for the number of skipped periods")
+    angles = _numpy.column_stack([-first[:,1], first[:,0]])/_ELECTRON_RIGIDITY
+    angles -= _numpy.mean(angles[central], axis=0)
+    angles2 = _numpy.sum(angles**2, axis=1)
+
+    dz = z[1] - z[0]
+    slip = _numpy.concatenate([[0.0], _numpy.cumsum((angles2[1:] + angles2[:-1])*(dz/2.0))])
+    phase = 2*_numpy.pi*(z + slip)/(period*(1.0 + _numpy.mean(angles2[central])))
+
+    poles = _numpy.arange(z[central][0], z[central][-1], period/2.0)
+    pole_phase = _numpy.interp(poles, z, phase)
+    pole_phase -= _numpy.polyval(_numpy.polyfit(poles, pole_phase, 1), poles)
+    errors = _numpy.degrees(pole_phase)
+    return _numpy.sqrt(_numpy.mean(errors**2)), poles, errors
 
 
 class Magnet(object):
 
-    def field(self, pos):
-        if isinstance(pos[0], (float, int)):
-            cpp_pos = _utils._vector_to_CppVector3D(pos)
-            cpp_field = self._cppobj.field(cpp_pos)
-            field = _utils._CppVector3D_to_vector(cpp_field)
+    _python_field = False
+
+    def field(self, pos, workers=None):
+        if workers is not None and workers > 1 and _numpy.ndim(pos) > 1:
+            return _parallel_field(self.field, pos, workers)
+        if _numpy.ndim(pos) == 1:
+            _profiling.count('field_calls')
+            _profiling.count('field_points')
+            with _profiling.phase('conversion'):
+                cpp_pos = _utils._vector_to_CppVector3D(pos)
+            with _profiling.phase('cpp_field'):
+                cpp_field = self._cppobj.field(cpp_pos)
+            with _profiling.phase('conversion'):
+                field = _utils._CppVector3D_to_vector(cpp_field)
         else:
-            cpp_pos = _utils._matrix_to_CppVectorVector3D(pos)
-            cpp_field = self._cppobj.field_vector(cpp_pos)
-            field = _utils._CppVectorVector3D_to_matrix(cpp_field)
+            _profiling.count('field_vector_calls')
+            _profiling.count('field_points', len(pos))
+            with _profiling.phase('conversion'):
+                cpp_pos = _utils._matrix_to_CppVectorVector3D(pos)
+            with _profiling.phase('cpp_field'):
+                cpp_field = self._cppobj.field_vector(cpp_pos)
+            with _profiling.phase('conversion'):
+                field = _utils._CppVectorVector3D_to_matrix(cpp_field)
         return field
 
     @property
@@ -45,6 +160,168 @@ class Magnet(object):
     def physical_length(self):
         return self._cppobj.get_physical_length()
 
+    def field_integrals(self, x, y, zmin, zmax, nrpts=10000, method='trapezoid', workers=None):
+        field_function = self.field if workers is None else (lambda pos: self.field(pos, workers=workers))
+        return _field_integrals(field_function, x, y, zmin, zmax, nrpts, method)
+
+    def field_integrals_grid(self, x, y, zmin, zmax, nrpts=10000, method='trapezoid', workers=None):
+        X, Y = _numpy.meshgrid(x, y)
+        return self.field_integrals(X, Y, zmin, zmax, nrpts, method, workers)
+
+    def phase_error(self, x=0.0, y=0.0, period=None, nrpts_per_period=100, skip_periods=2):
+        if period is None:
+            period = getattr(self, 'period', None)
+            if period is None:
+                raise Exception("The period of the magnet could not be detected")
+        return _phase_error(self.field, x, y, self.zmin, self.zmax, period, nrpts_per_period, skip_periods)
+
+
+class CachedFieldMagnet(Magnet):
+
+    _python_field = True
+
+    def __init__(self, magnet, x, y, z, lazy=False, tile_size=16, field=None):
+        self._magnet = magnet
+        self._axes = [_numpy.asarray(a, dtype=_numpy.float64) for a in (x, y, z)]
+        for a in self._axes:
+            if len(a) < 4:
+                raise Exception("CachedFieldMagnet needs at least 4 points per axis")
+            if not _numpy.allclose(_numpy.diff(a), a[1] - a[0]):
+                raise Exception("CachedFieldMagnet axes must be uniformly spaced")
+        self._origin = _numpy.array([a[0] for a in self._axes])
+        self._delta = _numpy.array([a[1] - a[0] for a in self._axes])
+        self._shape = tuple(len(a) for a in self._axes)
+        self._tile_size = int(tile_size)
+        if self._tile_size < 4:
+            # the 4-point stencil of a position must fall in at most two tiles per axis
+            raise Exception("CachedFieldMagnet tile_size must be at least 4")
+        self._field = _numpy.empty(self._shape + (3,))
+        nr_tiles = tuple(-(-n // self._tile_size) for n in self._shape)
+        self._computed = _numpy.zeros(nr_tiles, dtype=bool)
+        self.nr_samples = 0
+        if field is not None:
+            self._field[...] = field
+            self._computed[...] = True
+        elif not lazy:
+            self._compute_tiles(_numpy.argwhere(~self._computed))
+
+    @property
+    def magnet(self):
+        return self._magnet
+
+    @property
+    def x(self):
+        return self._axes[0]
+
+    @property
+    def y(self):
+        return self._axes[1]
+
+    @property
+    def z(self):
+        return self._axes[2]
+
+    @property
+    def xmin(self):
+        return self._magnet.xmin
+
+    @property
+    def xmax(self):
+        return self._magnet.xmax
+
+    @property
+    def ymin(self):
+        return self._magnet.ymin
+
+    @property
+    def ymax(self):
+        return self._magnet.ymax
+
+    @property
+    def zmin(self):
+        return self._magnet.zmin
+
+    @property
+    def zmax(self):
+        return self._magnet.zmax
+
+    @property
+    def physical_length(self):
+        return self._magnet.physical_length
+
+    def _compute_tiles(self, tiles):
+        ts = self._tile_size
+        for tile in tiles:
+            slices = tuple(slice(t*ts, min((t+1)*ts, n)) for t, n in zip(tile, self._shape))
+            X, Y, Z = _numpy.meshgrid(*[a[sl] for a, sl in zip(self._axes, slices)], indexing='ij')
+            pos = _numpy.column_stack([X.ravel(), Y.ravel(), Z.ravel()])
+            field = _numpy.atleast_2d(self._magnet.field(pos))
+            self._field[slices] = field.reshape(X.shape + (3,))
+            self._computed[tuple(tile)] = True
+            self.nr_samples += len(pos)
+
+    def _ensure_computed(self, idx):
+        if self._computed.all():
+            return
+        lo = (idx - 1)//self._tile_size
+        hi = (idx + 2)//self._tile_size
+        corners = [_numpy.where(_numpy.array(c, dtype=bool), hi, lo) for c in _numpy.ndindex(2, 2, 2)]
+        tiles = _numpy.unique(_numpy.vstack(corners), axis=0)
+        missing = [t for t in tiles if not self._computed[tuple(t)]]
+        if missing:
+            self._compute_tiles(missing)
+
+    def _stencil(self, pos):
+        pos = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+        u = (pos - self._origin)/self._delta
+        upper = _numpy.array(self._shape) - 1
+        if _numpy.any(u < -1e-9) or _numpy.any(u > upper + 1e-9):
+            raise Exception("Position out of CachedFieldMagnet grid")
+        idx = _numpy.clip(_numpy.floor(u).astype(int), 1, upper - 2)
+        t = u - idx
+        weights = _numpy.stack([-t*(t-1)*(t-2)/6, (t+1)*(t-1)*(t-2)/2,
+                                -(t+1)*t*(t-2)/2, (t+1)*t*(t-1)/6], axis=-1)
+        return idx, weights
+
+    def contains(self, pos):
+        u = (_numpy.atleast_2d(pos) - self._origin)/self._delta
+        upper = _numpy.array(self._shape) - 1
+        return _numpy.all((u >= -1e-9) & (u <= upper + 1e-9), axis=1)
+
+    def field(self, pos, workers=None):
+        if workers is not None and workers > 1 and _numpy.ndim(pos) > 1:
+            return _parallel_field(self.field, pos, workers)
+        idx, w = self._stencil(pos)
+        self._ensure_computed(idx)
+        _profiling.count_field(len(idx), _numpy.ndim(pos) > 1)
+        with _profiling.phase('python_field'):
+            field = _numpy.zeros((len(idx), 3))
+            for a in range(4):
+                for b in range(4):
+                    wab = w[:,0,a]*w[:,1,b]
+                    for c in range(4):
+                        values = self._field[idx[:,0]+a-1, idx[:,1]+b-1, idx[:,2]+c-1]
+                        field += (wab*w[:,2,c])[:,None]*values
+        return field[0] if _numpy.ndim(pos) == 1 else field
+
+    def error_bound(self):
+        # The cubic Lagrange error is f4*h**4*(t+1)*t*(t-1)*(t-2)/24, with
+        # f4*h**4 estimated by fourth differences of the sampled field along
+        # each axis. The polynomial is bounded by 9/16 on [0,1], but by 15/16
+        # on [-1,0] and [1,2], where the stencils clamped at the grid edges
+        # are evaluated.
+        self._compute_tiles(_numpy.argwhere(~self._computed))
+        bound = _numpy.zeros(3)
+        for axis in range(3):
+            d4 = _numpy.diff(self._field, n=4, axis=axis).reshape(-1, 3)
+            bound += (15.0/16.0/24.0)*_numpy.max(_numpy.abs(d4), axis=0)
+        return bound
+
+    def error_estimate(self, pos):
+        exact = _numpy.atleast_2d(self._magnet.field(pos))
+        interpolated = _numpy.atleast_2d(self.field(pos))
+        return _numpy.max(_numpy.abs(interpolated - exact), axis=0)
+
 
 class Grid(object):
 
@@ -70,25 +347,46 @@ class Grid(object):
         return list(cpp_y)
 
 
+def _mask_contains(cpp_mask, points):
+    points = _numpy.atleast_2d(_numpy.asarray(points, dtype=_numpy.float64))
+    if points.ndim != 2 or points.shape[1] not in (2, 3):
+        raise Exception("Invalid points array for mask")
+    cpp_pos = _idcpp.CppVector3D()
+    inside = _numpy.empty(len(points), dtype=bool)
+    for i, p in enumerate(points[:,:2].tolist()):
+        cpp_pos.x, cpp_pos.y = p
+        inside[i] = cpp_mask.is_inside(cpp_pos)
+    return inside
+
+
 class Mask(object):
 
     valid_shapes = ["ELLIPSE", "RECTANGLE", "DIAMOND", "TABLE", "NONE"]
 
     def __init__(self, shape=None, width=0.0, height=0.0, filename=None):
+        self.width, self.height, self.filename = width, height, filename
         if shape is not None:
-            if shape.upper() not in valid_shapes:
+            if shape.upper() not in Mask.valid_shapes:
                 raise Exception("Invalid shape")
             else:
+                self.shape = shape.upper()
                 self._cppobj = _idcpp.Mask(shape.upper(), width, height)
         elif filename is not None:
+            self.shape = "TABLE"
             self._cppobj = _idcpp.Mask(filename)
         elif shape is None and filename is None:
+            self.shape = "NONE"
             self._cppobj = _idcpp.Mask("NONE", width, height)
 
     def is_inside(self, pos):
         cpp_pos = _utils._vector_to_CppVector3D(pos)
         return self._cppobj.is_inside(cpp_pos)
 
+    def contains(self, points):
+        if self.shape == "NONE":
+            return _numpy.ones(len(_numpy.atleast_2d(points)), dtype=bool)
+        return _mask_contains(self._cppobj, points)
+
 
 class KickMap(object):
 
@@ -107,68 +405,154 @@ class KickMap(object):
             cpp_kick_y = _utils._matrix_to_CppDoubleVectorVector(kick_y)
             self._cppobj = _idcpp.KickMap(id_length, cpp_x, cpp_y, cpp_kick_x, cpp_kick_y)
 
+    _arrays = None
+
+    def __getattr__(self, name):
+        # Maps opened with KickMap.load are backed by read-only memmaps; the
+        # C++ object is only built when some function needs it.
+        if name == '_cppobj' and self._arrays is not None:
+            a = self._arrays
+            kickmap = KickMap(a['id_length'], a['x'], a['y'], a['kick_x'], a['kick_y'])
+            self._cppobj = kickmap._cppobj
+            return self._cppobj
+        raise AttributeError(name)
+
     @property
     def id_length(self):
+        if self._arrays is not None:
+            return self._arrays['id_length']
         return self._cppobj.id_length
 
     @property
     def x(self):
-        return list(self._cppobj.x)
+        if self._arrays is not None:
+            return self._arrays['x']
+        return _utils._CppDoubleVector_to_vector(self._cppobj.x)
 
     @property
     def y(self):
-        return list(self._cppobj.y)
+        if self._arrays is not None:
+            return self._arrays['y']
+        return _utils._CppDoubleVector_to_vector(self._cppobj.y)
 
     @property
     def kick_x(self):
+        if self._arrays is not None:
+            return self._arrays['kick_x']
         return _utils._CppDoubleVectorVector_to_matrix(self._cppobj.kick_x)
 
     @property
     def kick_y(self):
+        if self._arrays is not None:
+            return self._arrays['kick_y']
         return _utils._CppDoubleVectorVector_to_matrix(self._cppobj.kick_y)
 
+    @property
+    def header(self):
+        if self._arrays is not None:
+            return dict(self._arrays['header'])
+        return {'id_length': self.id_length, 'nx': len(self.x), 'ny': len(self.y)}
+
+    @_profiling.phased('io')
+    def save(self, filename, provenance=None):
+        x, y = _numpy.ascontiguousarray(self.x, dtype='<f8'), _numpy.ascontiguousarray(self.y, dtype='<f8')
+        kick_x = _numpy.ascontiguousarray(self.kick_x, dtype='<f8')
+        kick_y = _numpy.ascontiguousarray(self.kick_y, dtype='<f8')
+        if provenance is None:
+            provenance = {}
+        provenance = dict(provenance)
+        provenance.setdefault('created', _time.strftime('%Y-%m-%dT%H:%M:%S'))
+        header = {
+            'id_length': float(self.id_length),
+            'nx': len(x),
+            'ny': len(y),
+            'units': {'id_length': 'm', 'x': 'm', 'y': 'm', 'kick_x': 'T2m2', 'kick_y': 'T2m2'},
+            'provenance': provenance,
+        }
+        text = _json.dumps(header).encode('utf-8')
+        prefix_size = len(_KICKMAP_MAGIC) + 8
+        padding = -(prefix_size + len(text)) % _KICKMAP_ALIGNMENT
+        text = text + b' '*padding
+        with open(filename, 'wb') as f:
+            f.write(_KICKMAP_MAGIC)
+            f.write(_struct.pack('<II', _KICKMAP_VERSION, len(text)))
+            f.write(text)
+            for array in (x, y, kick_x, kick_y):
+                array.tofile(f)
+
+    @staticmethod
+    @_profiling.phased('io')
+    def load(filename):
+        with open(filename, 'rb') as f:
+            if f.read(len(_KICKMAP_MAGIC)) != _KICKMAP_MAGIC:
+                raise Exception("Invalid binary kickmap file")
+            version, header_size = _struct.unpack('<II', f.read(8))
+            if version != _KICKMAP_VERSION:
+                raise Exception("Unsupported binary kickmap version")
+            header = _json.loads(f.read(header_size).decode('utf-8'))
+        nx, ny = header['nx'], header['ny']
+        offset = len(_KICKMAP_MAGIC) + 8 + header_size
+        if _os.path.getsize(filename) != offset + 8*(nx + ny + 2*nx*ny):
+            raise Exception("Truncated binary kickmap file")
+        data = _numpy.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(nx + ny + 2*nx*ny,))
+        kickmap = KickMap.__new__(KickMap)
+        kickmap._arrays = {
+            'header': header,
+            'id_length': header['id_length'],
+            'x': data[:nx],
+            'y': data[nx:nx+ny],
+            'kick_x': data[nx+ny:nx+ny+nx*ny].reshape(ny, nx),
+            'kick_y': data[nx+ny+nx*ny:].reshape(ny, nx),
+        }
+        return kickmap
+
+    @staticmethod
+    def text_to_binary(text_filename, binary_filename):
+        kickmap = KickMap.read_from_file(text_filename)
+        kickmap.save(binary_filename, provenance={'source': text_filename})
+
+    @staticmethod
+    def binary_to_text(binary_filename, text_filename):
+        KickMap.load(binary_filename).write_to_file(text_filename)
+
+    @staticmethod
+    def _format_table(x, y, kick, indent):
+        nan_padding = 'nan' + ' '*10
+        row_format = '%+e '*len(x)
+        lines = [' '*indent + row_format % tuple(x) + '\n']
+        for yi, row in zip(y, kick.tolist()):
+            lines.append('%+e ' % yi + (row_format % tuple(row)).replace('nan ', nan_padding) + '\n')
+        return ''.join(lines)
+
+    @_profiling.phased('io')
     def write_to_file(self, filename):
-        f = open(filename, 'w')
-        print("# KICKMAP", file=f)
-        print("# Author: Luana N. P. Vilela @ LNLS, Date: ", file=f)
-        print("# ID Length [m]", file=f)
-        print(self.id_length, file=f)
-        print("# Number of Horizontal Points",file=f)
-        print(len(self.x), file=f)
-        print("# Number of Vertical Points",file=f)
-        print(len(self.y), file=f)
-
-        print("# Horizontal KickTable in T2m2", file=f)
-        print("START", file=f)
-        print(' '*13, end ='', file=f)
-        for j in range(len(self.x)):
-            print('%+e'%self.x[j], end=' ', file=f)
-        print('\n', end='', file=f)
-        for i in range(len(self.y)):
-            print('%+e'%self.y[i], end=' ', file=f)
-            for j in range(len(self.x)):
-                if _numpy.isnan(self.kick_x[i,j]):
-                    print('%+e'%self.kick_x[i,j] + ' '*9, end=' ', file=f)
-                else:
-                    print('%+e'%self.kick_x[i,j], end=' ', file=f)
-            print('\n', end='', file =f)
-
-        print("# Vertical KickTable in T2m2", file=f)
-        print("START", file=f)
-        print(' '*14, end ='', file=f)
-        for j in range(len(self.x)):
-            print('%+e'%self.x[j], end=' ', file=f)
-        print('\n', end='', file=f)
-        for i in range(len(self.y)):
-            print('%+e'%self.y[i], end=' ', file=f)
-            for j in range(len(self.x)):
-                if _numpy.isnan(self.kick_y[i,j]):
-                    print('%+e'%self.kick_y[i,j] + ' '*9, end=' ', file=f)
-                else:
-                    print('%+e'%self.kick_y[i,j], end=' ', file=f)
-            print('\n', end='', file =f)
+        x, y = self.x.tolist(), self.y.tolist()
+        kick_x, kick_y = self.kick_x, self.kick_y
+        with open(filename, 'w') as f:
+            print("# KICKMAP", file=f)
+            print("# Author: Luana N. P. Vilela @ LNLS, Date: ", file=f)
+            print("# ID Length [m]", file=f)
+            print(self.id_length, file=f)
+            print("# Number of Horizontal Points",file=f)
+            print(len(x), file=f)
+            print("# Number of Vertical Points",file=f)
+            print(len(y), file=f)
+
+            print("# Horizontal KickTable in T2m2", file=f)
+            print("START", file=f)
+            f.write(KickMap._format_table(x, y, kick_x, 13))
+
+            print("# Vertical KickTable in T2m2", file=f)
+            print("START", file=f)
+            f.write(KickMap._format_table(x, y, kick_y, 14))
+
+    @staticmethod
+    def _parse_table(lines, nrows):
+        values = _numpy.array(' '.join(lines).split(), dtype=_numpy.float64)
+        return values.reshape(nrows, -1)
 
     @staticmethod
+    @_profiling.phased('io')
     def read_from_file(filename):
         with open(filename, encoding='latin-1') as f:
             lines = [line.strip() for line in f]
@@ -177,14 +561,9 @@ class KickMap(object):
         id_length = float(lines[3])
         nx = int(lines[5])
         ny = int(lines[7])
-        x = _numpy.array([float(l) for l in lines[10].split()])
-        ykx = []
-        yky = []
-        for i in range(ny):
-            ykx.append([float(l) for l in lines[i+11].split()])
-            yky.append([float(l) for l in lines[i+14+ny].split()])
-        ykx = _numpy.array(ykx)
-        yky = _numpy.array(yky)
+        x = _numpy.array(lines[10].split(), dtype=_numpy.float64)
+        ykx = KickMap._parse_table(lines[11:11+ny], ny)
+        yky = KickMap._parse_table(lines[14+ny:14+2*ny], ny)
 
         y = ykx[:,0]
         kick_x = ykx[:,1:]
@@ -193,13 +572,100 @@ class KickMap(object):
         kickmap = KickMap(id_length, x, y, kick_x, kick_y)
         return kickmap
 
+    def apply_mask(self, mask):
+        x, y = self.x, self.y
+        X, Y = _numpy.meshgrid(x, y)
+        points = _numpy.column_stack([X.ravel(), Y.ravel()])
+        if isinstance(mask, Mask):
+            inside = mask.contains(points)
+        else:
+            inside = _mask_contains(mask, points)
+        outside = ~inside.reshape(X.shape)
+        kick_x, kick_y = _numpy.array(self.kick_x), _numpy.array(self.kick_y)
+        kick_x[outside] = _numpy.nan
+        kick_y[outside] = _numpy.nan
+        if self._arrays is not None:
+            self.__dict__.pop('_cppobj', None)
+            self._arrays = dict(self._arrays, kick_x=kick_x, kick_y=kick_y)
+        else:
+            self._cppobj.kick_x = _utils._matrix_to_CppDoubleVectorVector(kick_x)
+            self._cppobj.kick_y = _utils._matrix_to_CppDoubleVectorVector(kick_y)
+
     @staticmethod
     def pass_through_mask(input_filename, output_filename, mask):
         kickmap = KickMap.read_from_file(input_filename)
-        for i in range(len(kickmap.y)):
-            for j in range(len(kickmap.x)):
-                pos = [kickmap.x[j], kickmap.y[i], 0.0]
-                if not mask.is_inside(pos):
-                    kickmap.kick_x[i,j] = _numpy.nan
-                    kickmap.kick_y[i,j] = _numpy.nan
+        kickmap.apply_mask(mask)
         kickmap.write_to_file(output_filename)
+
+
+class KickMapCache(object):
+
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        if not _os.path.isdir(directory):
+            _os.makedirs(directory)
+
+    def _path(self, key):
+        return _os.path.join(self.directory, key + '.kmap')
+
+    def _entries(self):
+        entries = []
+        for name in _os.listdir(self.directory):
+            if name.endswith('.kmap'):
+                path = _os.path.join(self.directory, name)
+                try:
+                    stat = _os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    @property
+    def size(self):
+        return sum(entry[1] for entry in self._entries())
+
+    def __contains__(self, key):
+        return _os.path.isfile(self._path(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            # the modification time records the last use for LRU eviction
+            _os.utime(path, None)
+        except (OSError, IOError):
+            return None
+        try:
+            return KickMap.load(path)
+        except Exception:
+            # corrupt or truncated entries are misses, put writes them again
+            try:
+                _os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, kickmap, provenance=None):
+        path = self._path(key)
+        tmp_path = '{0}.{1}.tmp'.format(path, _os.getpid())
+        kickmap.save(tmp_path, provenance)
+        _os.replace(tmp_path, path)
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        entries = self._entries()
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                _os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for mtime, size, path in self._entries():
+            _os.remove(path)
@@ -1,16 +1,588 @@
 
+import time as _time
+import collections as _collections
+import hashlib as _hashlib
 from mpl_toolkits.mplot3d import Axes3D as _Axes3D
 import matplotlib.pyplot as _plt
 import numpy as _numpy
 import idcpp as _idcpp
 import idpy.utils as _utils
 import idpy.auxiliary as _auxiliary
+import idpy.profiling as _profiling
 
 
 class CassetteException(Exception):
     pass
 
 
+def _block_arrays(cpp_container):
+    n = cpp_container.size()
+    values = []
+    for i in range(n):
+        cpp_block = cpp_container.get_item(i)
+        for v in (cpp_block.get_mag(), cpp_block.get_dim(), cpp_block.get_pos()):
+            values += (v.x, v.y, v.z)
+    values = _numpy.array(values, dtype=_numpy.float64).reshape(n, 3, 3)
+    return values[:,0].copy(), values[:,1].copy(), values[:,2].copy()
+
+def _set_block_arrays(cpp_container, mag=None, dim=None, pos=None):
+    # get_item returns a reference to the block stored in the container
+    n = cpp_container.size()
+    arrays = []
+    for name, values in (('set_mag', mag), ('set_dim', dim), ('set_pos', pos)):
+        if values is not None:
+            values = _numpy.asarray(values, dtype=_numpy.float64)
+            if values.shape != (n, 3):
+                raise CassetteException("Block arrays must have shape (number of blocks, 3)")
+            arrays.append((name, values.tolist()))
+    cpp_vector = _idcpp.CppVector3D()
+    for i in range(n):
+        cpp_block = cpp_container.get_item(i)
+        for name, values in arrays:
+            cpp_vector.x, cpp_vector.y, cpp_vector.z = values[i]
+            getattr(cpp_block, name)(cpp_vector)
+
+def _containers_blocks(cpp_containers):
+    return [c.get_item(i) for c in cpp_containers for i in range(c.size())]
+
+def _containers_block_arrays(cpp_containers):
+    arrays = [_block_arrays(c) for c in cpp_containers]
+    return tuple(_numpy.vstack(a) for a in zip(*arrays))
+
+def _cassette_period(cpp_cassette):
+    N = int(cpp_cassette.get_number_of_blocks_per_period())
+    mag, dim, pos = _block_arrays(cpp_cassette)
+    if len(pos) > N:
+        return pos[N,2] - pos[0,2]
+    return N*(dim[0,2] + float(cpp_cassette.get_block_separation()))
+
+def _periodic_z_nodes(zmin, zmax, period, points_per_period):
+    dz = period/points_per_period
+    nz = int(_numpy.ceil((zmax - zmin)/dz)) + 1
+    return zmin + dz*_numpy.arange(nz)
+
+def _periodic_field_table(cpp_cassette, x, y, z):
+    # The field of the cassette is the sum of the field of its first period
+    # shifted by n*period. With the z step dividing the period, the kernel is
+    # sampled once on an extended z axis and the shifted sum is a strided
+    # moving sum. Blocks that break the periodicity are added as corrections.
+    N = int(cpp_cassette.get_number_of_blocks_per_period())
+    P = int(cpp_cassette.get_number_of_periods())
+    period = _cassette_period(cpp_cassette)
+    dz = z[1] - z[0]
+    m = int(round(period/dz))
+    if abs(m*dz - period) > 1e-9*period:
+        raise CassetteException("The z step must divide the period of the cassette")
+
+    kernel = BlockContainer([Block(block=cpp_cassette.get_item(i)) for i in range(N)])
+    nr_ext = len(z) + (P-1)*m
+    nr_pad = -(-nr_ext // m)*m
+    z_ext = z[0] - (P-1)*m*dz + dz*_numpy.arange(nr_pad)
+    X, Y, Z = _numpy.meshgrid(x, y, z_ext, indexing='ij')
+    pos = _numpy.column_stack([X.ravel(), Y.ravel(), Z.ravel()])
+    field_ext = kernel.field(pos).reshape(X.shape + (3,))
+
+    shape = (len(x), len(y), nr_pad//m, m, 3)
+    csum = _numpy.cumsum(field_ext.reshape(shape), axis=2).reshape(field_ext.shape)
+    k = (P-1)*m + _numpy.arange(len(z))
+    table = csum[:,:,k].copy()
+    valid = k - P*m >= 0
+    table[:,:,valid] -= csum[:,:,k[valid] - P*m]
+
+    mag, dim, pos_blocks = _block_arrays(cpp_cassette)
+    X, Y, Z = _numpy.meshgrid(x, y, z, indexing='ij')
+    pos = _numpy.column_stack([X.ravel(), Y.ravel(), Z.ravel()])
+    for i in range(N, len(mag)):
+        shift = (i//N)*period
+        ideal_pos = pos_blocks[i%N] + [0, 0, shift]
+        if (_numpy.allclose(mag[i], mag[i%N], rtol=0, atol=1e-12) and
+            _numpy.allclose(dim[i], dim[i%N], rtol=0, atol=1e-12) and
+            _numpy.allclose(pos_blocks[i], ideal_pos, rtol=0, atol=1e-12)):
+            continue
+        actual = Block(block=cpp_cassette.get_item(i))
+        ideal = Block(mag[i%N], dim[i%N], ideal_pos)
+        correction = actual.field(pos) - ideal.field(pos)
+        table += correction.reshape(X.shape + (3,))
+    return table
+
+def _periodic_mode_field(magnet, pos):
+    positions = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+    table = magnet._periodic_table
+    inside = table.contains(positions)
+    field = _numpy.empty(positions.shape)
+    if _numpy.any(inside):
+        field[inside] = table.field(positions[inside])
+    if not _numpy.all(inside):
+        field[~inside] = table.magnet.field(positions[~inside])
+    return field[0] if _numpy.ndim(pos) == 1 else field
+
+def _exact_magnet(cppobj):
+    magnet = _auxiliary.Magnet()
+    magnet._cppobj = cppobj
+    return magnet
+
+
+def _block_gmatrices(r, pos, dim):
+    # Field matrices of uniformly magnetized rectangular blocks, B = G.M,
+    # evaluated outside the blocks. Same expressions as idcpp's get_gmatrix.
+    d = _numpy.atleast_2d(pos) - _numpy.atleast_2d(r)
+    half = _numpy.atleast_2d(dim)/2.0
+    corners = (d - half, d + half)
+    q = _numpy.zeros((len(d), 3, 3))
+    with _numpy.errstate(divide='ignore', invalid='ignore'):
+        for i in range(2):
+            x = corners[i][:,0]
+            for j in range(2):
+                y = corners[j][:,1]
+                for k in range(2):
+                    z = corners[k][:,2]
+                    s = _numpy.sqrt(x*x + y*y + z*z)
+                    sign = (-1)**(i+j+k)
+                    q[:,0,0] -= sign*_numpy.arctan(y*z/(x*s))
+                    q[:,1,1] -= sign*_numpy.arctan(x*z/(y*s))
+                    q[:,2,2] -= sign*_numpy.arctan(x*y/(z*s))
+                    q[:,0,1] += sign*_numpy.log(z + s)
+                    q[:,0,2] += sign*_numpy.log(y + s)
+                    q[:,1,2] += sign*_numpy.log(x + s)
+    q[:,1,0], q[:,2,0], q[:,2,1] = q[:,0,1], q[:,0,2], q[:,1,2]
+    return -q/(4*_numpy.pi)
+
+def demagnetization_tensor(points, pos, dim):
+    # Reference demagnetization tensors of a rectangular block at the
+    # points, get_matrix(point) is minus the tensor at that point.
+    return -_block_gmatrices(_utils._vector_array(points), pos, dim)
+
+def _cpp_gmatrices(cppobj, points):
+    # get_gmatrix at many points, reusing a single CppVector3D
+    points = _utils._vector_array(points)
+    cpp_pos = _idcpp.CppVector3D()
+    values = []
+    for x, y, z in points.tolist():
+        cpp_pos.x, cpp_pos.y, cpp_pos.z = x, y, z
+        cpp_matrix = cppobj.get_gmatrix(cpp_pos)
+        for i in range(3):
+            row = cpp_matrix.row(i)
+            values += (row.x, row.y, row.z)
+    return _numpy.array(values, dtype=_numpy.float64).reshape(len(points), 3, 3)
+
+
+def _probe_gmatrices(cpp_blocks, dim, pos):
+    # idcpp field matrix of each block at a point outside its outer box,
+    # which depends on the subvolumes, and the matrix of the box alone
+    probe = pos + dim*[0.9, 1.1, 1.3]
+    g_cpp = _numpy.array([_cpp_gmatrices(b, probe[i:i+1])[0] for i, b in enumerate(cpp_blocks)]).reshape(-1, 3, 3)
+    return g_cpp, _block_gmatrices(probe, pos, dim).reshape(-1, 3, 3)
+
+def _irregular_blocks(cpp_blocks, dim, pos):
+    # Blocks whose idcpp field matrix differs from the one of their outer box,
+    # e.g. chamfered blocks with subvolumes. The box expressions are not
+    # valid for them and they must be evaluated with idcpp.
+    g_cpp, g_box = _probe_gmatrices(cpp_blocks, dim, pos)
+    scale = _numpy.max(_numpy.abs(g_box), axis=(1,2))
+    return _numpy.any(_numpy.abs(g_cpp - g_box) > 1e-9*_numpy.abs(g_box) + 1e-12*scale[:,None,None], axis=(1,2))
+
+def _exact_gmatrices(cpp_block, points, pos, dim, irregular=False):
+    # Box expressions where they are valid, idcpp inside the block and for
+    # blocks with subvolumes
+    if irregular:
+        return _cpp_gmatrices(cpp_block, points)
+    g = _block_gmatrices(points, pos, dim)
+    inside = _numpy.all(_numpy.abs(points - pos) <= _numpy.asarray(dim)/2, axis=1)
+    if _numpy.any(inside):
+        g[inside] = _cpp_gmatrices(cpp_block, points[inside])
+    return g
+
+
+class _FarFieldModel(object):
+
+    # With a tolerance the error of the approximation at each point is at
+    # most the tolerance: blocks beyond a z window are dropped with their
+    # summed field bounded by half the tolerance, and inside the window the
+    # dipole approximation is used while the summed bound of its error stays
+    # below the other half. The remaining pairs are evaluated exactly.
+    # Block k, with half diagonal s, at distance d > s from a point:
+    #   |B|            <= 2*|M|*V/(4*pi*(d - s)^3)
+    #   |B - B_dipole| <= |M|*V*(a^2 + b^2 + c^2)/(4*pi*(d - s)^5)
+    # from the Taylor remainder of the dipole kernel, a, b and c the sides.
+
+    _window_ratio = 2**0.25
+
+    def __init__(self, cpp_containers, near_radius, tolerance=None, chunk_size=1024):
+        cpp_blocks = _containers_blocks(cpp_containers)
+        mag, dim, pos = _containers_block_arrays(cpp_containers) if cpp_blocks else 3*(_numpy.zeros((0,3)),)
+        irregular = _irregular_blocks(cpp_blocks, dim, pos)
+        self._irregular = [(cpp_blocks[i], mag[i]) for i in _numpy.flatnonzero(irregular)]
+        mag, dim, pos = mag[~irregular], dim[~irregular], pos[~irregular]
+        order = _numpy.argsort(pos[:,2], kind='mergesort')
+        self._cpp_blocks = [cpp_blocks[i] for i in _numpy.flatnonzero(~irregular)[order]]
+        self._mag, self._dim, self._pos = mag[order], dim[order], pos[order]
+        self._zsorted = self._pos[:,2]
+        self._volume = _numpy.prod(self._dim, axis=1)
+        self._half_diagonal = _numpy.linalg.norm(self._dim, axis=1)/2
+        self.near_radius = near_radius
+        self.tolerance = tolerance
+        if tolerance is not None and len(self._pos):
+            mag_norm = _numpy.linalg.norm(self._mag, axis=1)
+            self._field_coef = 2*mag_norm*self._volume/(4*_numpy.pi)
+            self._error_coef = mag_norm*self._volume*_numpy.sum(self._dim**2, axis=1)/(4*_numpy.pi)
+            self._field_csum = _numpy.concatenate([[0.0], _numpy.cumsum(self._field_coef)])
+            extent = self._zsorted[-1] - self._zsorted[0]
+            r0 = max(near_radius, 2*_numpy.max(self._half_diagonal), 1e-12)
+            nr_windows = max(int(_numpy.ceil(_numpy.log(max(extent, r0)/r0)/_numpy.log(self._window_ratio))), 0) + 1
+            self._windows = r0*self._window_ratio**_numpy.arange(nr_windows + 4)
+        self._chunk_size = chunk_size
+        self.counters = {'exact': 0, 'dipole': 0, 'dropped': 0}
+
+    def _outside_weight(self, z, radius):
+        lo = _numpy.searchsorted(self._zsorted, z - radius, 'left')
+        hi = _numpy.searchsorted(self._zsorted, z + radius, 'right')
+        return self._field_csum[-1] - (self._field_csum[hi] - self._field_csum[lo])
+
+    def _window(self, positions):
+        # Smallest window whose dropped blocks satisfy the bound, summed over
+        # z shells (R_j, 2*R_j] where the distance to the blocks exceeds R_j.
+        if self.tolerance is None or not len(self._pos):
+            return _numpy.full(len(positions), _numpy.inf)
+        z = positions[:,2]
+        windows = self._windows
+        s = _numpy.max(self._half_diagonal)
+        outside = _numpy.column_stack([self._outside_weight(z, w) for w in windows] + 4*[_numpy.zeros(len(z))])
+        terms = (outside[:,:-4] - outside[:,4:])/(windows - s)**3
+        bound = terms.copy()
+        for j in range(len(windows) - 5, -1, -1):
+            bound[:,j] += bound[:,j+4]
+        valid = bound <= self.tolerance/2
+        return _numpy.where(_numpy.any(valid, axis=1), windows[_numpy.argmax(valid, axis=1)], _numpy.inf)
+
+    def _pairs(self, positions, window):
+        lo = _numpy.searchsorted(self._zsorted, positions[:,2] - window, 'left')
+        hi = _numpy.searchsorted(self._zsorted, positions[:,2] + window, 'right')
+        counts = hi - lo
+        points = _numpy.repeat(_numpy.arange(len(positions)), counts)
+        starts = _numpy.repeat(_numpy.cumsum(counts) - counts, counts)
+        blocks = _numpy.arange(len(points)) - starts + _numpy.repeat(lo, counts)
+        return points, blocks
+
+    def _dipole_pairs(self, points, blocks, dist, candidates):
+        if self.tolerance is None:
+            return candidates
+        # per point, dipoles in increasing order of error bound while the
+        # summed bound stays within half the tolerance
+        index = _numpy.flatnonzero(candidates)
+        gap = dist[index] - self._half_diagonal[blocks[index]]
+        with _numpy.errstate(over='ignore'):
+            bound = _numpy.minimum(self._error_coef[blocks[index]]/gap**5, self.tolerance)
+        order = _numpy.lexsort((bound, points[index]))
+        index, bound = index[order], bound[order]
+        csum = _numpy.cumsum(bound)
+        first = _numpy.r_[True, points[index][1:] != points[index][:-1]]
+        offset = _numpy.maximum.accumulate(_numpy.where(first, csum - bound, 0.0))
+        dipole = _numpy.zeros(len(points), dtype=bool)
+        dipole[index[csum - offset <= self.tolerance/2]] = True
+        return dipole
+
+    def _field_chunk(self, positions):
+        n = len(positions)
+        points, blocks = self._pairs(positions, self._window(positions))
+        r = positions[points] - self._pos[blocks]
+        dist = _numpy.sqrt(_numpy.sum(r*r, axis=1))
+        candidates = (dist >= self.near_radius) & (dist > self._half_diagonal[blocks])
+        far = self._dipole_pairs(points, blocks, dist, candidates)
+        near = ~far
+
+        contrib = _numpy.zeros((len(points), 3))
+        if _numpy.any(near):
+            g = _block_gmatrices(positions[points[near]], self._pos[blocks[near]], self._dim[blocks[near]])
+            inside = _numpy.all(_numpy.abs(r[near]) <= self._dim[blocks[near]]/2, axis=1)
+            for k in _numpy.flatnonzero(inside):
+                g[k] = _cpp_gmatrices(self._cpp_blocks[blocks[near][k]], positions[points[near][k]][None])[0]
+            contrib[near] = _numpy.einsum('kij,kj->ki', g, self._mag[blocks[near]])
+        if _numpy.any(far):
+            u = r[far]/dist[far,None]
+            m = self._mag[blocks[far]]
+            mu = _numpy.sum(m*u, axis=1)[:,None]
+            coef = (self._volume[blocks[far]]/(4*_numpy.pi*dist[far]**3))[:,None]
+            contrib[far] = coef*(3*mu*u - m)
+
+        field = _numpy.empty((n, 3))
+        for c in range(3):
+            field[:,c] = _numpy.bincount(points, weights=contrib[:,c], minlength=n)
+        for cpp_block, mag in self._irregular:
+            field += _numpy.einsum('kij,j->ki', _cpp_gmatrices(cpp_block, positions), mag)
+        nr_near, nr_far = int(_numpy.sum(near)) + n*len(self._irregular), int(_numpy.sum(far))
+        self.counters['exact'] += nr_near
+        self.counters['dipole'] += nr_far
+        self.counters['dropped'] += n*(len(self._pos) + len(self._irregular)) - nr_near - nr_far
+        return field
+
+    def field(self, pos):
+        positions = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+        _profiling.count_field(len(positions), _numpy.ndim(pos) > 1)
+        field = _numpy.empty(positions.shape)
+        with _profiling.phase('python_field'):
+            for i in range(0, len(positions), self._chunk_size):
+                field[i:i+self._chunk_size] = self._field_chunk(positions[i:i+self._chunk_size])
+        return field[0] if _numpy.ndim(pos) == 1 else field
+
+
+def _far_field_report(magnet, pos):
+    positions = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+    model = magnet._far_field
+    t0 = _time.time()
+    exact = _auxiliary.Magnet.field(magnet, positions)
+    t1 = _time.time()
+    counters = dict(model.counters)
+    approximate = model.field(positions)
+    t2 = _time.time()
+    error = _numpy.abs(approximate - exact)
+    return {
+        'nr_points': len(positions),
+        'near_radius': model.near_radius,
+        'tolerance': model.tolerance,
+        'max_error': float(_numpy.max(error)),
+        'rms_error': float(_numpy.sqrt(_numpy.mean(error**2))),
+        'max_field': float(_numpy.max(_numpy.abs(exact))),
+        'exact_time': t1 - t0,
+        'approximate_time': t2 - t1,
+        'speedup': (t1 - t0)/(t2 - t1) if t2 > t1 else _numpy.inf,
+        'nr_exact_pairs': model.counters['exact'] - counters['exact'],
+        'nr_dipole_pairs': model.counters['dipole'] - counters['dipole'],
+        'nr_dropped_pairs': model.counters['dropped'] - counters['dropped'],
+    }
+
+
+def _copy_magnet(magnet):
+    # Copy of the C++ object with a wrapper of the same class, without the
+    # field approximations and response matrices that refer to the original
+    # C++ object.
+    copy = type(magnet).__new__(type(magnet))
+    excluded = ('_far_field', '_periodic_table', '_response_matrices')
+    copy.__dict__.update((k, v) for k, v in magnet.__dict__.items() if k not in excluded)
+    copy._cppobj = type(magnet._cppobj)(magnet._cppobj)
+    return copy
+
+def _cpp_block_containers(magnet):
+    if isinstance(magnet, CassetteContainer):
+        return [magnet._cppobj.get_item(i) for i in range(magnet._cppobj.size())]
+    elif isinstance(magnet, BlockContainer):
+        return [magnet._cppobj]
+    else:
+        raise CassetteException("Invalid magnet, it must be a block or cassette container")
+
+def _magnetization_errors(mag, rng, amplitude, angle, distribution):
+    if distribution == 'normal':
+        sample = lambda size: rng.standard_normal(size)
+    elif distribution == 'uniform':
+        sample = lambda size: rng.uniform(-1.0, 1.0, size)
+    else:
+        raise CassetteException("Invalid error distribution")
+    n = len(mag)
+    norm = _numpy.linalg.norm(mag, axis=1)
+    factor = 1.0 + amplitude*sample(n)
+    theta = angle*sample(n)
+    # rotation by theta about a random axis perpendicular to the magnetization
+    with _numpy.errstate(divide='ignore', invalid='ignore'):
+        u = mag/norm[:,None]
+        axis = rng.standard_normal((n, 3))
+        axis -= _numpy.sum(axis*u, axis=1)[:,None]*u
+        axis /= _numpy.linalg.norm(axis, axis=1)[:,None]
+        direction = u*_numpy.cos(theta)[:,None] + _numpy.cross(axis, u)*_numpy.sin(theta)[:,None]
+    new_mag = (norm*factor)[:,None]*direction
+    return _numpy.where(norm[:,None] > 0, new_mag, mag)
+
+def _evaluate_instance(state, index):
+    ensemble, function = state
+    return index, function(ensemble.instance(index))
+
+
+class MagnetizationErrorEnsemble(object):
+
+    def __init__(self, magnet, nr_instances, amplitude=0.0, angle=0.0, distribution='normal', seed=None):
+        self._magnet = magnet
+        self._cpp_containers = _cpp_block_containers(magnet)
+        self._mag = [_block_arrays(c)[0] for c in self._cpp_containers]
+        self.nr_instances = nr_instances
+        self.amplitude = amplitude
+        self.angle = angle
+        self.distribution = distribution
+        self.seed = _numpy.random.SeedSequence().entropy if seed is None else seed
+
+    def __len__(self):
+        return self.nr_instances
+
+    def magnetizations(self, index):
+        # Every instance has its own generator, so it does not depend on the
+        # order or the process in which instances are built.
+        if not 0 <= index < self.nr_instances:
+            raise IndexError("Instance index out of range")
+        rng = _numpy.random.default_rng([self.seed, index])
+        return [_magnetization_errors(mag, rng, self.amplitude, self.angle, self.distribution) for mag in self._mag]
+
+    def instance(self, index):
+        magnet = _copy_magnet(self._magnet)
+        for cpp_container, mag in zip(_cpp_block_containers(magnet), self.magnetizations(index)):
+            _set_block_arrays(cpp_container, mag=mag)
+        return magnet
+
+    def __iter__(self):
+        for index in range(self.nr_instances):
+            yield self.instance(index)
+
+    def evaluate(self, function, indices=None, workers=None):
+        if indices is None:
+            indices = range(self.nr_instances)
+        return _utils._fork_imap(_evaluate_instance, (self, function), list(indices), workers)
+
+def _import_scipy_sparse():
+    try:
+        import scipy.sparse as sparse
+    except ImportError:
+        return None
+    return sparse
+
+def _line_integral_operator(z):
+    # Rows giving the first and second integrals of (bx, by, bz) along the
+    # points z from the field sampled at those points, ordered [b(z0), b(z1), ...].
+    z = _numpy.asarray(z, dtype=float)
+    n = len(z)
+    dz = _numpy.diff(z)
+    first = _numpy.zeros((n, n))
+    for k in range(1, n):
+        first[k] = first[k-1]
+        first[k,k-1] += dz[k-1]/2.0
+        first[k,k] += dz[k-1]/2.0
+    second = (first[1:] + first[:-1]).T.dot(dz)/2.0
+    operator = _numpy.zeros((6, 3*n))
+    for c in range(3):
+        operator[c, c::3] = first[-1]
+        operator[3+c, c::3] = second
+    return operator
+
+def _response_dense(points, cpp_blocks, dim, pos):
+    irregular = _irregular_blocks(cpp_blocks, dim, pos)
+    matrix = _numpy.empty((3*len(points), 3*len(pos)))
+    for b in range(len(pos)):
+        matrix[:,3*b:3*b+3] = _exact_gmatrices(cpp_blocks[b], points, pos[b], dim[b], irregular[b]).reshape(-1, 3)
+    return matrix
+
+def _compress_response(matrix, tolerance):
+    # Entries or singular values below tolerance times the largest one are
+    # discarded, and the smallest of the dense, low-rank and sparse (when
+    # scipy is available) representations is kept.
+    if tolerance is None:
+        return 'dense', matrix
+    nr_rows, nr_cols = matrix.shape
+    options = [(matrix.size, 'dense', matrix)]
+    u, s, vt = _numpy.linalg.svd(matrix, full_matrices=False)
+    rank = int(_numpy.sum(s > tolerance*s[0])) if len(s) and s[0] > 0 else 0
+    options.append((rank*(nr_rows + nr_cols), 'lowrank', (u[:,:rank]*s[:rank], vt[:rank])))
+    sparse = _import_scipy_sparse()
+    if sparse is not None:
+        kept = _numpy.abs(matrix) > tolerance*_numpy.max(_numpy.abs(matrix))
+        # a value and a column index for each stored entry
+        options.append((2*_numpy.count_nonzero(kept), 'sparse', sparse.csr_matrix(_numpy.where(kept, matrix, 0.0))))
+    size, storage, data = min(options, key=lambda option: option[0])
+    return storage, data
+
+def _cached_response_matrix(magnet, pos, tolerance, max_entries=4):
+    # The response depends only on the geometry of the blocks and on the
+    # observation points, so it is reused while the magnetizations change.
+    pos = _utils._vector_array(pos)
+    cpp_containers = _cpp_block_containers(magnet)
+    mag, dim, block_pos = _containers_block_arrays(cpp_containers)
+    # the probe matrices change with the subvolumes of the blocks
+    g_cpp, g_box = _probe_gmatrices(_containers_blocks(cpp_containers), dim, block_pos)
+    h = _hashlib.sha1()
+    for a in (pos, dim, block_pos, g_cpp):
+        h.update(a.tobytes())
+    key = (h.hexdigest(), tolerance)
+    cache = magnet.__dict__.get('_response_matrices')
+    # a cache built for another C++ object, e.g. one copied along with the
+    # wrapper attributes, is replaced instead of shared
+    if cache is None or any(m._cppobj is not magnet._cppobj for m in cache.values()):
+        cache = magnet._response_matrices = _collections.OrderedDict()
+    if key not in cache:
+        cache[key] = ResponseMatrix(magnet, pos, tolerance)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+    return cache[key]
+
+
+class ResponseMatrix(object):
+
+    def __init__(self, magnet, pos, tolerance=None):
+        self._cppobj = magnet._cppobj
+        self._cpp_containers = _cpp_block_containers(magnet)
+        self.pos = _utils._vector_array(pos).copy()
+        self.tolerance = tolerance
+        mag, dim, block_pos = _containers_block_arrays(self._cpp_containers)
+        self.shape = (3*len(self.pos), 3*len(block_pos))
+        dense = _response_dense(self.pos, _containers_blocks(self._cpp_containers), dim, block_pos)
+        self.storage, self._data = _compress_response(dense, tolerance)
+        self._integral_matrices = None
+
+    @property
+    def nr_blocks(self):
+        return self.shape[1]//3
+
+    def _vector(self, mag):
+        v = _numpy.asarray(mag, dtype=float).ravel()
+        if v.size != self.shape[1]:
+            raise CassetteException("Magnetizations must have shape (number of blocks, 3)")
+        return v
+
+    def matrix(self):
+        if self.storage == 'lowrank':
+            return self._data[0].dot(self._data[1])
+        elif self.storage == 'sparse':
+            return self._data.toarray()
+        return self._data
+
+    def dot(self, mag):
+        v = self._vector(mag)
+        if self.storage == 'lowrank':
+            result = self._data[0].dot(self._data[1].dot(v))
+        else:
+            result = self._data.dot(v)
+        return _numpy.asarray(result).reshape(-1, 3)
+
+    def field(self, mag=None):
+        if mag is None:
+            mag = _containers_block_arrays(self._cpp_containers)[0]
+        return self.dot(mag)
+
+    def reduce(self, operator):
+        # Response of linear functions of the field, operator has 3*npoints columns
+        operator = _numpy.asarray(operator, dtype=float)
+        if self.storage == 'lowrank':
+            return operator.dot(self._data[0]).dot(self._data[1])
+        elif self.storage == 'sparse':
+            return _numpy.asarray(self._data.T.dot(operator.T)).T
+        return operator.dot(self._data)
+
+    def integral_matrices(self):
+        # first and second field integrals along the points, ordered in z
+        if self._integral_matrices is None:
+            z = self.pos[:,2]
+            if _numpy.any(_numpy.diff(z) <= 0):
+                raise CassetteException("Points must be ordered in z for field integrals")
+            response = self.reduce(_line_integral_operator(z))
+            self._integral_matrices = response[:3], response[3:]
+        return self._integral_matrices
+
+    def field_integrals(self, mag=None):
+        if mag is None:
+            mag = _containers_block_arrays(self._cpp_containers)[0]
+        first, second = self.integral_matrices()
+        v = self._vector(mag)
+        return first.dot(v), second.dot(v)
+
+    def kick_matrix(self, brho):
+        # first order angular kicks (px, py) of a particle along the points
+        first = self.integral_matrices()[0]
+        return _numpy.vstack([first[1], -first[0]])/brho
+
+
 class SubVolume(object):
 
     def __init__(self, dim=None, pos=[0,0,0], strength=1.0, subvolume=None):
@@ -31,6 +603,9 @@ class SubVolume(object):
         cpp_matrix = self._cppobj.get_gmatrix(cpp_pos)
         return _utils._CppMatrix3D_to_matrix(cpp_matrix)
 
+    def get_matrices(self, points):
+        return _cpp_gmatrices(self._cppobj, points)
+
     @property
     def dim(self):
         cpp_dim = self._cppobj.dim
@@ -85,7 +660,7 @@ class Block(_auxiliary.Magnet):
 
     def add_subvolume(self, subvolume):
         if isinstance(subvolume, SubVolume):
-            self._cppobj.add_subvolume(subvolume._subvolume)
+            self._cppobj.add_subvolume(subvolume._cppobj)
         elif isinstance(subvolume, _idcpp.SubVolume):
             self._cppobj.add_subvolume(subvolume)
 
@@ -105,6 +680,9 @@ class Block(_auxiliary.Magnet):
         cpp_matrix = self._cppobj.get_gmatrix(cpp_pos)
         return _utils._CppMatrix3D_to_matrix(cpp_matrix)
 
+    def get_matrices(self, points):
+        return _cpp_gmatrices(self._cppobj, points)
+
     @property
     def mag(self):
         cpp_mag = self._cppobj.get_mag()
@@ -183,6 +761,9 @@ class Block(_auxiliary.Magnet):
 
 class BlockContainer(_auxiliary.Magnet):
 
+    _far_field = None
+    _periodic_table = None
+
     def __init__(self, blocks, blockcontainer=None):
         if blockcontainer is not None:
             if isinstance(blockcontainer, BlockContainer):
@@ -219,6 +800,72 @@ class BlockContainer(_auxiliary.Magnet):
     def shift_pos(self, pos):
         cpp_pos = _utils._vector_to_CppVector3D(pos)
         self._cppobj.shift_pos(cpp_pos)
+        self._update_field_models()
+
+    def get_block_arrays(self):
+        return _block_arrays(self._cppobj)
+
+    def set_block_arrays(self, mag=None, dim=None, pos=None):
+        _set_block_arrays(self._cppobj, mag, dim, pos)
+        self._update_field_models()
+
+    @property
+    def magnetizations(self):
+        return _block_arrays(self._cppobj)[0]
+
+    @magnetizations.setter
+    def magnetizations(self, values):
+        self.set_block_arrays(mag=values)
+
+    @property
+    def dimensions(self):
+        return _block_arrays(self._cppobj)[1]
+
+    @dimensions.setter
+    def dimensions(self, values):
+        self.set_block_arrays(dim=values)
+
+    @property
+    def positions(self):
+        return _block_arrays(self._cppobj)[2]
+
+    @positions.setter
+    def positions(self, values):
+        self.set_block_arrays(pos=values)
+
+    def _update_field_models(self):
+        # field approximations are rebuilt on the same nodes after the blocks change
+        if self._far_field is not None:
+            self.enable_far_field_approximation(self._far_field.near_radius, self._far_field.tolerance)
+        if self._periodic_table is not None:
+            table = self._periodic_table
+            field = _periodic_field_table(self._cppobj, table.x, table.y, table.z)
+            self._periodic_table = _auxiliary.CachedFieldMagnet(_exact_magnet(self._cppobj), table.x, table.y, table.z, field=field)
+
+    @property
+    def _python_field(self):
+        return self._periodic_table is not None or self._far_field is not None
+
+    def field(self, pos, workers=None):
+        if workers is not None and workers > 1 and _numpy.ndim(pos) > 1:
+            return _auxiliary._parallel_field(self.field, pos, workers)
+        if self._far_field is not None:
+            return self._far_field.field(pos)
+        return _auxiliary.Magnet.field(self, pos)
+
+    def response_matrix(self, pos, tolerance=None):
+        return _cached_response_matrix(self, pos, tolerance)
+
+    def enable_far_field_approximation(self, near_radius, tolerance=None):
+        self._far_field = _FarFieldModel([self._cppobj], near_radius, tolerance)
+
+    def disable_far_field_approximation(self):
+        self._far_field = None
+
+    def far_field_report(self, pos):
+        if self._far_field is None:
+            raise CassetteException("Far field approximation is not enabled")
+        return _far_field_report(self, pos)
 
     def plot(self, block_color='blue', alpha=0.1, arrow_color='black', arrow_width=3, fig=None, ax=None):
         is_interactive = _plt.isinteractive()
@@ -228,12 +875,11 @@ class BlockContainer(_auxiliary.Magnet):
             fig = _plt.figure()
             ax =  fig.add_subplot(111, projection='3d')
 
+        mags, dims, positions = _block_arrays(self._cppobj)
         for i in range(self.size):
-            cpp_block = self._cppobj.get_item(i)
-            block = Block(block=cpp_block)
-            mag = block.mag
-            pos = 1000*block.pos
-            dim = 1000*block.dim
+            mag = mags[i]
+            pos = 1000*positions[i]
+            dim = 1000*dims[i]
 
             x1 = pos[0] - dim[0]/2.0
             x2 = pos[0] + dim[0]/2.0
@@ -293,11 +939,7 @@ class HalbachCassette(BlockContainer):
 
     @property
     def magnetization_vector(self):
-        mag = []
-        for i in range(self._cppobj.size()):
-            mag_cpp = self._cppobj.get_item(i).get_mag()
-            mag.append(_utils._CppVector3D_to_vector(mag_cpp))
-        return _numpy.array(mag)
+        return self.magnetizations
 
     @property
     def center_pos(self):
@@ -308,20 +950,45 @@ class HalbachCassette(BlockContainer):
     def center_pos(self, pos):
         pos_cpp = _utils._vector_to_CppVector3D(pos)
         self._cppobj.set_center_pos(pos_cpp)
+        self._update_field_models()
 
     def set_xcenter(self, x):
         self._cppobj.set_xcenter(x)
+        self._update_field_models()
 
     def set_ycenter(self, y):
         self._cppobj.set_ycenter(y)
+        self._update_field_models()
 
     def set_zcenter(self, z):
         self._cppobj.set_zcenter(z)
+        self._update_field_models()
 
     def get_dim(self):
         cpp_dim = self._cppobj.get_dim()
         return _utils._CppVector3D_to_vector(cpp_dim)
 
+    @property
+    def period(self):
+        return _cassette_period(self._cppobj)
+
+    def field(self, pos, workers=None):
+        if workers is not None and workers > 1 and _numpy.ndim(pos) > 1:
+            return _auxiliary._parallel_field(self.field, pos, workers)
+        if self._periodic_table is not None:
+            return _periodic_mode_field(self, pos)
+        return BlockContainer.field(self, pos)
+
+    def enable_periodic_mode(self, x, y, points_per_period=64, margin=None):
+        period = self.period
+        if margin is None: margin = period
+        z = _periodic_z_nodes(self.zmin - margin, self.zmax + margin, period, points_per_period)
+        table = _periodic_field_table(self._cppobj, _numpy.asarray(x, dtype=float), _numpy.asarray(y, dtype=float), z)
+        self._periodic_table = _auxiliary.CachedFieldMagnet(_exact_magnet(self._cppobj), x, y, z, field=table)
+
+    def disable_periodic_mode(self):
+        self._periodic_table = None
+
     def plot(self, nr_periods=1, block_color='blue', alpha=0.1, arrow_color='black', arrow_width=3, fig=None, ax=None):
         if nr_periods > self.nr_periods:
             raise CassetteException("The number of periods should be less or equal the number of periods of the Halbach cassette")
@@ -333,12 +1000,11 @@ class HalbachCassette(BlockContainer):
             fig = _plt.figure()
             ax =  fig.add_subplot(111, projection='3d')
 
+        mags, dims, positions = _block_arrays(self._cppobj)
         for i in range(self.N*nr_periods):
-            cpp_block = self._cppobj.get_item(i)
-            block = Block(block=cpp_block)
-            mag = block.mag
-            pos = 1000*block.pos
-            dim = 1000*block.dim
+            mag = mags[i]
+            pos = 1000*positions[i]
+            dim = 1000*dims[i]
 
             x1 = pos[0] - dim[0]/2.0
             x2 = pos[0] + dim[0]/2.0
@@ -371,6 +1037,9 @@ class HalbachCassette(BlockContainer):
 
 class CassetteContainer(_auxiliary.Magnet):
 
+    _far_field = None
+    _periodic_table = None
+
     def __init__(self, cassettes, cassettecontainer=None):
         if cassettecontainer is not None:
             if isinstance(cassettecontainer, CassetteContainer):
@@ -415,10 +1084,65 @@ class CassetteContainer(_auxiliary.Magnet):
             self._cppobj.add_element(cassette)
         else:
             raise CassetteException("Invalid argument for add_element function")
+        self._update_field_models()
 
     def get_item(self, index):
         return HalbachCassette(halbachcassette=self._cppobj.get_item(index))
 
+    @property
+    def period(self):
+        return _cassette_period(self._cppobj.get_item(0))
+
+    def _update_field_models(self):
+        # field approximations are rebuilt with the same parameters after the
+        # cassettes move, the z range of the periodic table follows them
+        if self._far_field is not None:
+            self.enable_far_field_approximation(self._far_field.near_radius, self._far_field.tolerance)
+        if self._periodic_table is not None:
+            self.enable_periodic_mode(*self._periodic_mode)
+
+    @property
+    def _python_field(self):
+        return self._periodic_table is not None or self._far_field is not None
+
+    def field(self, pos, workers=None):
+        if workers is not None and workers > 1 and _numpy.ndim(pos) > 1:
+            return _auxiliary._parallel_field(self.field, pos, workers)
+        if self._periodic_table is not None:
+            return _periodic_mode_field(self, pos)
+        if self._far_field is not None:
+            return self._far_field.field(pos)
+        return _auxiliary.Magnet.field(self, pos)
+
+    def enable_periodic_mode(self, x, y, points_per_period=64, margin=None):
+        parameters = (x, y, points_per_period, margin)
+        period = self.period
+        if margin is None: margin = period
+        z = _periodic_z_nodes(self.zmin - margin, self.zmax + margin, period, points_per_period)
+        x, y = _numpy.asarray(x, dtype=float), _numpy.asarray(y, dtype=float)
+        table = _numpy.zeros((len(x), len(y), len(z), 3))
+        for i in range(self.size):
+            table += _periodic_field_table(self._cppobj.get_item(i), x, y, z)
+        self._periodic_table = _auxiliary.CachedFieldMagnet(_exact_magnet(self._cppobj), x, y, z, field=table)
+        self._periodic_mode = parameters
+
+    def disable_periodic_mode(self):
+        self._periodic_table = None
+
+    def response_matrix(self, pos, tolerance=None):
+        return _cached_response_matrix(self, pos, tolerance)
+
+    def enable_far_field_approximation(self, near_radius, tolerance=None):
+        self._far_field = _FarFieldModel(_cpp_block_containers(self), near_radius, tolerance)
+
+    def disable_far_field_approximation(self):
+        self._far_field = None
+
+    def far_field_report(self, pos):
+        if self._far_field is None:
+            raise CassetteException("Far field approximation is not enabled")
+        return _far_field_report(self, pos)
+
     def plot(self, nr_periods=1, block_color='blue', alpha=0.1, arrow_color='black', arrow_width=3):
         if nr_periods > self.nr_periods:
             raise CassetteException("Invalid number of periods")
@@ -428,15 +1152,13 @@ class CassetteContainer(_auxiliary.Magnet):
         fig = _plt.figure()
         ax =  fig.add_subplot(111, projection='3d')
 
-        for i in range(self.size):
-            c = HalbachCassette(halbachcassette=self._cppobj.get_item(i))
-            N = self._cppobj.get_item(0).get_number_of_blocks_per_period()
+        N = self._cppobj.get_item(0).get_number_of_blocks_per_period()
+        for k in range(self.size):
+            mags, dims, positions = _block_arrays(self._cppobj.get_item(k))
             for i in range(N*nr_periods):
-                cpp_block = c.get_item(i)
-                block = Block(block=cpp_block)
-                mag = block.mag
-                pos = 1000*block.pos
-                dim = 1000*block.dim
+                mag = mags[i]
+                pos = 1000*positions[i]
+                dim = 1000*dims[i]
                 x1 = pos[0] - dim[0]/2.0
                 x2 = pos[0] + dim[0]/2.0
                 y1 = pos[1] - dim[1]/2.0
@@ -1,101 +1,341 @@
 
+import hashlib as _hashlib
+import itertools as _itertools
+import json as _json
+import os as _os
 import numpy as _numpy
 import matplotlib.pyplot as _plt
 import idcpp as _idcpp
 import idpy.utils as _utils
+import idpy.auxiliary as _auxiliary
+import idpy.profiling as _profiling
 
 
 class FieldMapException(Exception):
     pass
 
 
+_HDF5_EXTENSIONS = ('.h5', '.hdf5')
+
+
+def _is_grid_file(filename):
+    return _os.path.splitext(filename)[1].lower() in ('.npy',) + _HDF5_EXTENSIONS
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise FieldMapException("h5py is needed for HDF5 field maps")
+    return h5py
+
+def _grid_metadata_filename(filename):
+    return filename + '.json'
+
+def _read_grid_metadata(filename):
+    if _os.path.splitext(filename)[1].lower() in _HDF5_EXTENSIONS:
+        h5py = _import_h5py()
+        with h5py.File(filename, 'r') as f:
+            return {'x': f['x'][()].tolist(), 'y': f['y'][()].tolist(), 'z': f['z'][()].tolist(),
+                    'completed_slabs': int(f.attrs['completed_slabs'])}
+    with open(_grid_metadata_filename(filename), 'r') as f:
+        return _json.load(f)
+
+def _write_grid_metadata(filename, metadata):
+    # replaced atomically, so it never describes more slabs than were written
+    metadata_filename = _grid_metadata_filename(filename)
+    with open(metadata_filename + '.tmp', 'w') as f:
+        _json.dump(metadata, f)
+    _os.replace(metadata_filename + '.tmp', metadata_filename)
+
+def _axis_weights(axis, u):
+    if len(axis) == 1:
+        return _numpy.zeros(len(u), dtype=int), _numpy.zeros(len(u))
+    i = _numpy.clip(_numpy.searchsorted(axis, u, side='right') - 1, 0, len(axis) - 2)
+    t = (u - axis[i])/(axis[i+1] - axis[i])
+    return i, t
+
+
+def _file_digest(filename, block_size=1 << 20):
+    h = _hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _read_fieldmap_text(filename, chunk_size=65536):
+    # Measurement files have a header ended by a dashed line followed by
+    # rows of x, y, z [mm] and bx, by, bz [T]. Rows are parsed in chunks of
+    # lines so that the text is never held in memory as a whole.
+    with open(filename, 'r') as f:
+        first = []
+        for line in f:
+            if line.startswith('---'):
+                break
+            words = line.split()
+            try:
+                [float(w) for w in words]
+            except ValueError:
+                continue
+            if len(words) >= 6:
+                first = [line]
+                break
+        nr_columns = None
+        chunks = []
+        lines = _itertools.chain(first, f)
+        while True:
+            text = ''.join(_itertools.islice(lines, chunk_size))
+            if not text.strip():
+                if not text:
+                    break
+                continue
+            if nr_columns is None:
+                nr_columns = len(text.strip().split('\n', 1)[0].split())
+            chunks.append(_numpy.fromstring(text, sep=' ').reshape(-1, nr_columns))
+    data = _numpy.vstack(chunks) if chunks else _numpy.zeros((0, 6))
+    pos, field = data[:,0:3]/1000.0, data[:,3:6]
+    axes = [_numpy.unique(pos[:,i]) for i in range(3)]
+    if len(pos) != len(axes[0])*len(axes[1])*len(axes[2]):
+        raise FieldMapException("Field map is not sampled on a rectilinear grid")
+    grid = _numpy.empty((len(axes[2]), len(axes[1]), len(axes[0]), 3))
+    idx = [_numpy.searchsorted(axes[i], pos[:,i]) for i in range(3)]
+    grid[idx[2], idx[1], idx[0]] = field
+    return axes[0], axes[1], axes[2], grid
+
+def _write_grid_fieldmap(filename, x, y, z, field, extra_metadata=None):
+    metadata = {'x': list(map(float, x)), 'y': list(map(float, y)), 'z': list(map(float, z)), 'completed_slabs': 0}
+    if extra_metadata is not None:
+        metadata.update(extra_metadata)
+    _write_grid_metadata(filename, metadata)
+    data = _numpy.lib.format.open_memmap(filename, mode='w+', dtype='<f8', shape=field.shape)
+    data[...] = field
+    data.flush()
+    del data
+    metadata['completed_slabs'] = len(z)
+    _write_grid_metadata(filename, metadata)
+
+def _cached_grid_fieldmap(filename, fieldmap3D=False):
+    # The binary sidecar is used while the size, mtime and SHA-256 of the
+    # source file match the ones recorded when it was written. The parsed
+    # grid is interpolated linearly, as the idcpp field maps, and without
+    # the y dependence for 2D field maps. When the sidecar can not be
+    # written the parsed grid is used without caching.
+    cache_filename = filename + '.cache.npy'
+    stat = _os.stat(filename)
+    digest = _file_digest(filename)
+    source = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest}
+    try:
+        metadata = _read_grid_metadata(cache_filename)
+    except (IOError, OSError, ValueError):
+        metadata = None
+    if (metadata is None or metadata.get('source') != source or not _os.path.isfile(cache_filename)
+            or metadata.get('completed_slabs') != len(metadata.get('z', []))):
+        x, y, z, field = _read_fieldmap_text(filename)
+        try:
+            _write_grid_fieldmap(cache_filename, x, y, z, field, {'source': source})
+        except (IOError, OSError):
+            fieldmap = _GridFieldMap(x, y, z, field)
+        else:
+            fieldmap = _GridFieldMap.load(cache_filename)
+    else:
+        fieldmap = _GridFieldMap.load(cache_filename)
+    if not fieldmap3D and len(fieldmap._y) != 1:
+        raise FieldMapException("Field map with several y planes needs fieldmap3D")
+    return fieldmap
+
+
+class _GridFieldMap(object):
+
+    # Field map sampled on a rectilinear grid, field array indexed [z, y, x],
+    # with multilinear interpolation between the nodes.
+
+    def __init__(self, x, y, z, field):
+        self._x, self._y, self._z = (_numpy.asarray(a, dtype=_numpy.float64) for a in (x, y, z))
+        self._field = field
+        self.x_min, self.x_max = self._x[0], self._x[-1]
+        self.y_min, self.y_max = self._y[0], self._y[-1]
+        self.z_min, self.z_max = self._z[0], self._z[-1]
+
+    @staticmethod
+    def load(filename):
+        metadata = _read_grid_metadata(filename)
+        nr_slabs = len(metadata['z'])
+        if metadata['completed_slabs'] < nr_slabs:
+            raise FieldMapException("Incomplete field map, resume the export first")
+        if _os.path.splitext(filename)[1].lower() in _HDF5_EXTENSIONS:
+            h5py = _import_h5py()
+            with h5py.File(filename, 'r') as f:
+                field = f['field'][()]
+        else:
+            field = _numpy.load(filename, mmap_mode='r')
+        return _GridFieldMap(metadata['x'], metadata['y'], metadata['z'], field)
+
+    def field(self, positions):
+        ix, tx = _axis_weights(self._x, positions[:,0])
+        iy, ty = _axis_weights(self._y, positions[:,1])
+        iz, tz = _axis_weights(self._z, positions[:,2])
+        shape = self._field.shape
+        field = _numpy.zeros((len(positions), 3))
+        for dz, wz in ((0, 1 - tz), (1, tz)):
+            for dy, wy in ((0, 1 - ty), (1, ty)):
+                for dx, wx in ((0, 1 - tx), (1, tx)):
+                    index = (_numpy.minimum(iz + dz, shape[0] - 1),
+                             _numpy.minimum(iy + dy, shape[1] - 1),
+                             _numpy.minimum(ix + dx, shape[2] - 1))
+                    field += (wz*wy*wx)[:,None]*self._field[index]
+        return field
+
+
 class FieldMap(object):
 
-    def __init__(self, label, filename_list, fieldmap3D=False):
+    out_of_range_policies = ("raise", "nan", "clamp", "zero")
+
+    def __init__(self, label, filename_list, fieldmap3D=False, cache=False, out_of_range="raise"):
         self.label = label
         if isinstance(filename_list, str):
             self._filename_list = [filename_list]
         else:
             self._filename_list = filename_list
-        cpp_filename_list = _idcpp.CppStringVector(self._filename_list)
-        self._cppobj = _idcpp.FieldMapContainer(cpp_filename_list, fieldmap3D)
+        if len(self._filename_list) == 1 and _is_grid_file(self._filename_list[0]):
+            self._cppobj = _GridFieldMap.load(self._filename_list[0])
+        elif cache:
+            if len(self._filename_list) != 1:
+                raise FieldMapException("Binary cache is only supported for single file field maps")
+            self._cppobj = _cached_grid_fieldmap(self._filename_list[0], fieldmap3D)
+        else:
+            cpp_filename_list = _idcpp.CppStringVector(self._filename_list)
+            self._cppobj = _idcpp.FieldMapContainer(cpp_filename_list, fieldmap3D)
+        self._bounds = _numpy.array([[self._cppobj.x_min, self._cppobj.y_min, self._cppobj.z_min],
+                                     [self._cppobj.x_max, self._cppobj.y_max, self._cppobj.z_max]], dtype=float)
+        self.out_of_range = out_of_range
 
     @property
     def filename_list(self):
         return self._filename_list
 
+    @property
+    def out_of_range(self):
+        return self._out_of_range
+
+    @out_of_range.setter
+    def out_of_range(self, policy):
+        if policy not in FieldMap.out_of_range_policies:
+            raise FieldMapException("Invalid out of range policy")
+        self._out_of_range = policy
+
     @property
     def x_min(self):
-        return self._cppobj.x_min
+        return self._bounds[0,0]
 
     @property
     def x_max(self):
-        return self._cppobj.x_max
+        return self._bounds[1,0]
 
     @property
     def y_min(self):
-        return self._cppobj.y_min
+        return self._bounds[0,1]
 
     @property
     def y_max(self):
-        return self._cppobj.y_max
+        return self._bounds[1,1]
 
     @property
     def z_min(self):
-        return self._cppobj.z_min
+        return self._bounds[0,2]
 
     @property
     def z_max(self):
-        return self._cppobj.z_max
+        return self._bounds[1,2]
 
 
     def _check_limits(self, pos):
-        if isinstance(pos[0], (float, int)): positions = [pos]
-        else: positions = pos
-        for p in positions:
-            if p[0] < self.x_min or p[0] > self.x_max:
-                raise FieldMapException("x out of range")
-            if p[1] < self.y_min or p[1] > self.y_max:
-                raise FieldMapException("y out of range")
-            if p[2] < self.z_min or p[2] > self.z_max:
-                raise FieldMapException("z out of range")
-
-    def field(self, pos):
-        self._check_limits(pos)
-        if isinstance(pos[0], (float, int)):
-            cpp_pos = _utils._vector_to_CppVector3D(pos)
+        positions = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+        outside = (positions < self._bounds[0]) | (positions > self._bounds[1])
+        for i, coord in enumerate("xyz"):
+            if _numpy.any(outside[:,i]):
+                raise FieldMapException(coord + " out of range")
+
+    def _field(self, positions):
+        if isinstance(self._cppobj, _GridFieldMap):
+            with _profiling.phase('python_field'):
+                return self._cppobj.field(positions)
+        with _profiling.phase('conversion'):
+            cpp_pos = _utils._matrix_to_CppVectorVector3D(positions)
+        with _profiling.phase('cpp_field'):
             cpp_field = self._cppobj.field(cpp_pos)
-            field = _utils._CppVector3D_to_vector(cpp_field)
+        with _profiling.phase('conversion'):
+            return _utils._CppVectorVector3D_to_matrix(cpp_field)
+
+    def field(self, pos, out_of_range=None):
+        policy = self._out_of_range if out_of_range is None else out_of_range
+        if policy not in FieldMap.out_of_range_policies:
+            raise FieldMapException("Invalid out of range policy")
+        positions = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+        _profiling.count_field(len(positions), _numpy.ndim(pos) > 1)
+        if policy == "raise":
+            self._check_limits(positions)
+            field = self._field(positions)
+        elif policy == "clamp":
+            field = self._field(_numpy.clip(positions, self._bounds[0], self._bounds[1]))
         else:
-            cpp_pos = _utils._matrix_to_CppVectorVector3D(pos)
-            cpp_field = self._cppobj.field(cpp_pos)
-            field = _utils._CppVectorVector3D_to_matrix(cpp_field)
-        return field
+            inside = _numpy.all((positions >= self._bounds[0]) & (positions <= self._bounds[1]), axis=1)
+            field = _numpy.full(positions.shape, _numpy.nan if policy == "nan" else 0.0)
+            if _numpy.any(inside):
+                field[inside] = self._field(positions[inside])
+        return field[0] if _numpy.ndim(pos) == 1 else field
+
+    def _line_positions(self, direction, pos, x=0.0, y=0.0, z=0.0):
+        positions = _numpy.empty((len(pos), 3))
+        positions[:] = [x, y, z]
+        if direction == "x":
+            positions[:,0] = pos
+        elif direction == "y":
+            positions[:,1] = pos
+        elif direction == "z":
+            positions[:,2] = pos
+        else:
+            raise FieldMapException("Invalid value for direction.")
+        return positions
 
     def _field_profile(self, field_component, direction, pos, x=0.0, y=0.0, z=0.0):
-        field_profile_x = []
-        field_profile_y = []
-        field_profile_z = []
-        for i in range(len(pos)):
-            if direction == "x":
-                field = self.field([pos[i], y, z])
-            elif direction == "y":
-                field = self.field([x, pos[i], z])
-            elif direction == "z":
-                field = self.field([x, y, pos[i]])
-            else:
-                raise FieldMapException("Invalid value for direction.")
-            field_profile_x.append(field[0])
-            field_profile_y.append(field[1])
-            field_profile_z.append(field[2])
-        if field_component == "x":
-            return _numpy.array([pos, field_profile_x])
-        elif field_component == "y":
-            return _numpy.array([pos, field_profile_y])
-        elif field_component == "z":
-            return _numpy.array([pos, field_profile_z])
-        else:
+        if field_component not in ("x", "y", "z"):
             raise FieldMapException("Invalid value for field component.")
+        positions = self._line_positions(direction, pos, x=x, y=y, z=z)
+        field = self.field(positions)
+        idx = "xyz".index(field_component)
+        return _numpy.array([pos, field[:,idx]])
+
+    def field_profile(self, direction, x=0.0, y=0.0, z=0.0, mm=False, nrpts=None):
+        if direction == "x":
+            pos = _numpy.linspace(self.x_min, self.x_max, 1000 if nrpts is None else nrpts)
+        elif direction == "y":
+            pos = _numpy.linspace(self.y_min, self.y_max, 1000 if nrpts is None else nrpts)
+        elif direction == "z":
+            pos = _numpy.linspace(self.z_min, self.z_max, 10000 if nrpts is None else nrpts)
+        else:
+            raise FieldMapException("Invalid value for direction.")
+        positions = self._line_positions(direction, pos, x=x, y=y, z=z)
+        field = self.field(positions)
+        field_profile = _numpy.vstack([pos, field.T])
+        if mm: field_profile[0] = field_profile[0]*1000.0
+        return field_profile
+
+    def field_integrals(self, x, y, zmin=None, zmax=None, nrpts=10000, method='trapezoid'):
+        if zmin is None: zmin = self.z_min
+        if zmax is None: zmax = self.z_max
+        return _auxiliary._field_integrals(self.field, x, y, zmin, zmax, nrpts, method)
+
+    def field_integrals_grid(self, x, y, zmin=None, zmax=None, nrpts=10000, method='trapezoid'):
+        X, Y = _numpy.meshgrid(x, y)
+        return self.field_integrals(X, Y, zmin, zmax, nrpts, method)
+
+    def phase_error(self, x=0.0, y=0.0, period=None, nrpts_per_period=100, skip_periods=2, zmin=None, zmax=None):
+        # same argument order as Magnet.phase_error, the period of a field map
+        # can not be detected; the integration starts two periods before zmin
+        if period is None:
+            raise FieldMapException("The period of the field map must be given")
+        if zmin is None: zmin = self.z_min + 2*period
+        if zmax is None: zmax = self.z_max - 2*period
+        return _auxiliary._phase_error(self.field, x, y, zmin, zmax, period, nrpts_per_period, skip_periods)
 
     def bx_x(self, y=0.0, z=0.0, mm=False, nrpts = 1000):
         pos = _numpy.linspace(self.x_min, self.x_max, nrpts)
@@ -152,54 +392,115 @@ class FieldMap(object):
         return field_profile
 
     def plot_field(self):
-        bx_x = self.bx_x(mm=True)
-        bx_y = self.bx_y(mm=True)
-        bx_z = self.bx_z(mm=True)
-        by_x = self.by_x(mm=True)
-        by_y = self.by_y(mm=True)
-        by_z = self.by_z(mm=True)
-        bz_x = self.bz_x(mm=True)
-        bz_y = self.bz_y(mm=True)
-        bz_z = self.bz_z(mm=True)
+        profile_x = self.field_profile("x", mm=True)
+        profile_y = self.field_profile("y", mm=True)
+        profile_z = self.field_profile("z", mm=True)
+        bx_x, by_x, bz_x = profile_x[[0,1]], profile_x[[0,2]], profile_x[[0,3]]
+        bx_y, by_y, bz_y = profile_y[[0,1]], profile_y[[0,2]], profile_y[[0,3]]
+        bx_z, by_z, bz_z = profile_z[[0,1]], profile_z[[0,2]], profile_z[[0,3]]
         pdf_names = ''
 
         pdf_names = pdf_names + 'bx_x.pdf' + ' '
-        __plt.plot(*bx_x), __plt.xlabel('x [mm]'), __plt.ylabel('Bx [T]')
-        __plt.title('Horizontal Field'), __plt.savefig('bx_x.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*bx_x), _plt.xlabel('x [mm]'), _plt.ylabel('Bx [T]')
+        _plt.title('Horizontal Field'), _plt.savefig('bx_x.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'bx_y.pdf' + ' '
-        __plt.plot(*bx_y), __plt.xlabel('y [mm]'), __plt.ylabel('Bx [T]')
-        __plt.title('Horizontal Field'), __plt.savefig('bx_y.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*bx_y), _plt.xlabel('y [mm]'), _plt.ylabel('Bx [T]')
+        _plt.title('Horizontal Field'), _plt.savefig('bx_y.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'bx_z.pdf' + ' '
-        __plt.plot(*bx_z), __plt.xlabel('z [mm]'), __plt.ylabel('Bx [T]')
-        __plt.title('Horizontal Field'), __plt.savefig('bx_z.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*bx_z), _plt.xlabel('z [mm]'), _plt.ylabel('Bx [T]')
+        _plt.title('Horizontal Field'), _plt.savefig('bx_z.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'by_x.pdf' + ' '
-        __plt.plot(*by_x), __plt.xlabel('x [mm]'), __plt.ylabel('By [T]')
-        __plt.title('Vertical Field'), __plt.savefig('by_x.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*by_x), _plt.xlabel('x [mm]'), _plt.ylabel('By [T]')
+        _plt.title('Vertical Field'), _plt.savefig('by_x.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'by_y.pdf' + ' '
-        __plt.plot(*by_y), __plt.xlabel('y [mm]'), __plt.ylabel('By [T]')
-        __plt.title('Vertical Field'), __plt.savefig('by_y.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*by_y), _plt.xlabel('y [mm]'), _plt.ylabel('By [T]')
+        _plt.title('Vertical Field'), _plt.savefig('by_y.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'by_z.pdf' + ' '
-        __plt.plot(*by_z), __plt.xlabel('z [mm]'), __plt.ylabel('By [T]')
-        __plt.title('Vertical Field'), __plt.savefig('by_z.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*by_z), _plt.xlabel('z [mm]'), _plt.ylabel('By [T]')
+        _plt.title('Vertical Field'), _plt.savefig('by_z.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'bz_x.pdf' + ' '
-        __plt.plot(*bz_x), __plt.xlabel('x [mm]'), __plt.ylabel('Bz [T]')
-        __plt.title('Longitudinal Field'), __plt.savefig('bz_x.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*bz_x), _plt.xlabel('x [mm]'), _plt.ylabel('Bz [T]')
+        _plt.title('Longitudinal Field'), _plt.savefig('bz_x.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'bz_y.pdf' + ' '
-        __plt.plot(*bz_y), __plt.xlabel('y [mm]'), __plt.ylabel('Bz [T]')
-        __plt.title('Longitudinal Field'), __plt.savefig('bz_y.pdf', bbox_inches='tight'), __plt.close(), __plt.figure()
+        _plt.plot(*bz_y), _plt.xlabel('y [mm]'), _plt.ylabel('Bz [T]')
+        _plt.title('Longitudinal Field'), _plt.savefig('bz_y.pdf', bbox_inches='tight'), _plt.close(), _plt.figure()
 
         pdf_names = pdf_names + 'bz_z.pdf' + ' '
-        __plt.plot(*bz_z), __plt.xlabel('z [mm]'), __plt.ylabel('Bz [T]')
-        __plt.title('Longitudinal Field'), __plt.savefig('bz_z.pdf', bbox_inches='tight'), __plt.close()
+        _plt.plot(*bz_z), _plt.xlabel('z [mm]'), _plt.ylabel('Bz [T]')
+        _plt.title('Longitudinal Field'), _plt.savefig('bz_z.pdf', bbox_inches='tight'), _plt.close()
 
         join_pdf = 'pdfunite ' + pdf_names +  self.label + '_field_profile.pdf'
         rm_pdf = 'rm -rf ' + pdf_names
-        os.system(join_pdf)
-        os.system(rm_pdf)
+        _os.system(join_pdf)
+        _os.system(rm_pdf)
+
+
+def export_fieldmap(magnet, filename, x, y, z, resume=True, slab_size=None, workers=None, compression='gzip'):
+    x, y, z = (_numpy.asarray(a, dtype=_numpy.float64) for a in (x, y, z))
+    hdf5 = _os.path.splitext(filename)[1].lower() in _HDF5_EXTENSIONS
+    shape = (len(z), len(y), len(x), 3)
+    if slab_size is None:
+        slab_size = max(1, 1000000//(len(x)*len(y)))
+
+    # a partially written map with the same axes is resumed from its last slab
+    completed = 0
+    if resume and _os.path.isfile(filename):
+        try:
+            metadata = _read_grid_metadata(filename)
+        except (IOError, OSError, ValueError, KeyError):
+            metadata = None
+        if metadata is not None:
+            if not all(_numpy.array_equal(metadata[k], a) for k, a in (('x', x), ('y', y), ('z', z))):
+                raise FieldMapException("Existing field map has different axes")
+            completed = metadata['completed_slabs']
+
+    if hdf5:
+        h5py = _import_h5py()
+        f = h5py.File(filename, 'a' if completed else 'w')
+        if not completed:
+            for name, axis in (('x', x), ('y', y), ('z', z)):
+                f.create_dataset(name, data=axis)
+            f.create_dataset('field', shape=shape, dtype='f8', chunks=(1, len(y), len(x), 3), compression=compression)
+            f.attrs['completed_slabs'] = 0
+        data = f['field']
+    else:
+        metadata = {'x': x.tolist(), 'y': y.tolist(), 'z': z.tolist(), 'completed_slabs': completed}
+        if completed:
+            data = _numpy.load(filename, mmap_mode='r+')
+        else:
+            # an earlier metadata file must not outlive the truncated data
+            _write_grid_metadata(filename, metadata)
+            data = _numpy.lib.format.open_memmap(filename, mode='w+', dtype='<f8', shape=shape)
+
+    try:
+        X, Y = _numpy.meshgrid(x, y)
+        for k in range(completed, len(z), slab_size):
+            slab = z[k:k+slab_size]
+            pos = _numpy.empty((len(slab), len(y), len(x), 3))
+            pos[...,0], pos[...,1] = X, Y
+            pos[...,2] = slab[:,None,None]
+            if workers is None:
+                field = magnet.field(pos.reshape(-1,3))
+            else:
+                field = magnet.field(pos.reshape(-1,3), workers=workers)
+            data[k:k+len(slab)] = _numpy.reshape(field, pos.shape)
+            completed = k + len(slab)
+            if hdf5:
+                f.attrs['completed_slabs'] = completed
+                f.flush()
+            else:
+                data.flush()
+                metadata['completed_slabs'] = completed
+                _write_grid_metadata(filename, metadata)
+    finally:
+        if hdf5:
+            f.close()
+        else:
+            del data
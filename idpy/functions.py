@@ -1,7 +1,11 @@
 
+import hashlib as _hashlib
+import time as _time
 import numpy as _numpy
 import idcpp as _idcpp
+import idpy as _idpy
 import idpy.utils as _utils
+import idpy.profiling as _profiling
 import idpy.auxiliary as _auxiliary
 import idpy.cassette as _cassette
 import idpy.idmodel as _idmodel
@@ -14,48 +18,130 @@ def calc_brho(energy):
     beta = _idcpp.doublep_value(beta_p)
     return brho, beta
 
-def runge_kutta(magnet, energy, r, p, zmax, step, mask=None, trajectory_flag=False):
-    brho, beta = calc_brho(energy)
-
+def _get_cpp_magnet(magnet, function_name):
     if isinstance(magnet, _auxiliary.Magnet):
-        cpp_magnet = magnet._cppobj
+        return magnet._cppobj
     elif isinstance(magnet, _idcpp.Magnet):
-        cpp_magnet = magnet
+        return magnet
     else:
-        raise Exception("Invalid argument for runge_kutta")
-
-    if mask is not None:
-        if isinstance(mask, _auxiliary.Mask):
-            cpp_mask = mask._cppobj
-        elif isinstance(mask, _idcpp.Mask):
-            cpp_mask = mask
-        else:
-            raise Exception("Invalid argument for runge_kutta")
+        raise Exception("Invalid argument for " + function_name)
+
+def _get_cpp_mask(mask, function_name):
+    if mask is None:
+        return _auxiliary.Mask()._cppobj
+    elif isinstance(mask, _auxiliary.Mask):
+        return mask._cppobj
+    elif isinstance(mask, _idcpp.Mask):
+        return mask
     else:
-        cpp_mask = _auxiliary.Mask()._cppobj
+        raise Exception("Invalid argument for " + function_name)
+
+def _is_python_magnet(magnet):
+    return isinstance(magnet, _auxiliary.Magnet) and magnet._python_field
+
+def runge_kutta(magnet, energy, r, p, zmax, step, mask=None, trajectory_flag=False):
+    if _is_python_magnet(magnet):
+        cpp_mask = None if mask is None else _get_cpp_mask(mask, "runge_kutta")
+        brho, beta = calc_brho(energy)
+        trajectory = [] if trajectory_flag else None
+        kicks, nr_evaluations = _track(magnet, brho, _utils._vector_array([r]), _utils._vector_array([p]), zmax, step, cpp_mask, trajectory=trajectory)
+        return _numpy.array(trajectory) if trajectory_flag else kicks[0]
+
+    cpp_magnet = _get_cpp_magnet(magnet, "runge_kutta")
+    cpp_mask = _get_cpp_mask(mask, "runge_kutta")
 
     cpp_r = _utils._vector_to_CppVector3D(r)
     cpp_p = _utils._vector_to_CppVector3D(p)
-    cpp_kick = _idcpp.CppVector3D()
 
     if trajectory_flag:
         cpp_trajectory = _idcpp.CppDoubleVectorVector()
-        _idcpp.runge_kutta(cpp_magnet, energy, cpp_r, cpp_p, zmax, step, cpp_mask, cpp_trajectory)
-        kick = _utils._CppVector3D_to_vector(cpp_kick)
+        _profiling.count('particles')
+        with _profiling.phase('cpp_tracking'):
+            _idcpp.runge_kutta(cpp_magnet, energy, cpp_r, cpp_p, zmax, step, cpp_mask, cpp_trajectory)
         trajectory = _utils._CppDoubleVectorVector_to_matrix(cpp_trajectory)
         return trajectory
     else:
-        _idcpp.runge_kutta(cpp_magnet, energy, cpp_r, cpp_p, zmax, step, cpp_mask, cpp_kick)
+        cpp_kick = _idcpp.CppVector3D()
+        _profiling.count('particles')
+        with _profiling.phase('cpp_tracking'):
+            _idcpp.runge_kutta(cpp_magnet, energy, cpp_r, cpp_p, zmax, step, cpp_mask, cpp_kick)
         kick = _utils._CppVector3D_to_vector(cpp_kick)
         return kick
 
-def calc_kickmap(magnet, energy, grid, zmin, zmax, rk_step, mask=None):
-    if isinstance(magnet, _auxiliary.Magnet):
-        cpp_magnet = magnet._cppobj
-    elif isinstance(magnet, _idcpp.Magnet):
-        cpp_magnet = magnet
+def runge_kutta_batch(magnet, energy, R, P, zmax, step, mask=None, trajectory_flag=False):
+    R = _utils._vector_array(R)
+    P = _utils._vector_array(P)
+    if len(R) != len(P):
+        raise Exception("R and P must have the same number of particles")
+
+    if _is_python_magnet(magnet):
+        # Python fields are tracked by _track, see _calc_kickmap
+        if trajectory_flag:
+            trajectories = [runge_kutta(magnet, energy, r, p, zmax, step, mask, True) for r, p in zip(R, P)]
+            return _numpy.array(trajectories)
+        cpp_mask = None if mask is None else _get_cpp_mask(mask, "runge_kutta_batch")
+        brho, beta = calc_brho(energy)
+        kicks = _numpy.empty((len(R), 3))
+        for z in _numpy.unique(R[:,2]):
+            sel = R[:,2] == z
+            kicks[sel] = _track(magnet, brho, R[sel], P[sel], zmax, step, cpp_mask)[0]
+        return kicks
+
+    cpp_magnet = _get_cpp_magnet(magnet, "runge_kutta_batch")
+    cpp_mask = _get_cpp_mask(mask, "runge_kutta_batch")
+
+    cpp_r = _idcpp.CppVector3D()
+    cpp_p = _idcpp.CppVector3D()
+
+    if trajectory_flag:
+        trajectories = []
+        for r, p in zip(R.tolist(), P.tolist()):
+            cpp_r.x, cpp_r.y, cpp_r.z = r
+            cpp_p.x, cpp_p.y, cpp_p.z = p
+            cpp_trajectory = _idcpp.CppDoubleVectorVector()
+            with _profiling.phase('cpp_tracking'):
+                _idcpp.runge_kutta(cpp_magnet, energy, cpp_r, cpp_p, zmax, step, cpp_mask, cpp_trajectory)
+            trajectories.append(_utils._CppDoubleVectorVector_to_matrix(cpp_trajectory))
+        _profiling.count('particles', len(R))
+        if len(set(t.shape for t in trajectories)) > 1:
+            raise Exception("Trajectories with different number of steps")
+        return _numpy.array(trajectories)
     else:
-        raise Exception("Invalid argument for calc_kickmap")
+        kicks = _numpy.empty((len(R), 3))
+        cpp_kick = _idcpp.CppVector3D()
+        for i, (r, p) in enumerate(zip(R.tolist(), P.tolist())):
+            cpp_r.x, cpp_r.y, cpp_r.z = r
+            cpp_p.x, cpp_p.y, cpp_p.z = p
+            with _profiling.phase('cpp_tracking'):
+                _idcpp.runge_kutta(cpp_magnet, energy, cpp_r, cpp_p, zmax, step, cpp_mask, cpp_kick)
+            kicks[i] = cpp_kick.x, cpp_kick.y, cpp_kick.z
+        _profiling.count('particles', len(R))
+        return kicks
+
+def _calc_kickmap_rows(state, rows):
+    start = _time.perf_counter()
+    cpp_magnet, energy, x, y, zmin, zmax, rk_step, cpp_mask = state
+    ys = [y[i] for i in rows]
+    cpp_grid = _idcpp.Grid(len(x), len(ys), x[0], x[-1], ys[0], ys[-1])
+    cpp_grid.x = _idcpp.CppDoubleVector(x)
+    cpp_grid.y = _idcpp.CppDoubleVector(ys)
+    cpp_kickmap = _idcpp.KickMap()
+    _idcpp.calc_kickmap(cpp_magnet, energy, cpp_grid, zmin, zmax, rk_step, cpp_mask, cpp_kickmap)
+    kick_x = _utils._CppDoubleVectorVector_to_matrix(cpp_kickmap.kick_x)
+    kick_y = _utils._CppDoubleVectorVector_to_matrix(cpp_kickmap.kick_y)
+    stats = _profiling.worker_stats(start, rows=len(rows), cells=len(x)*len(rows))
+    return cpp_kickmap.id_length, kick_x, kick_y, stats
+
+def _calc_kickmap(magnet, energy, grid, zmin, zmax, rk_step, mask=None, workers=None):
+    # idcpp's integrator can only evaluate C++ fields, so magnets with a
+    # Python field (CachedFieldMagnet, periodic mode, far-field approximation)
+    # are tracked by the Dormand-Prince integrator of _track with the same
+    # fixed step. The kicks agree with idcpp's to the integration error and
+    # id_length is the physical length of the magnet, as in idcpp.
+    if _is_python_magnet(magnet):
+        return _calc_kickmap_python(magnet, energy, grid, zmin, zmax, rk_step, mask, workers=workers)[0]
+
+    cpp_magnet = _get_cpp_magnet(magnet, "calc_kickmap")
 
     if isinstance(grid, _auxiliary.Grid):
         cpp_grid = grid._cppobj
@@ -64,17 +150,279 @@ def calc_kickmap(magnet, energy, grid, zmin, zmax, rk_step, mask=None):
     else:
         raise Exception("Invalid argument for calc_kickmap")
 
-    if mask is not None:
-        if isinstance(mask, _auxiliary.Mask):
-            cpp_mask = mask._cppobj
-        elif isinstance(mask, _idcpp.Mask):
-            cpp_mask = mask
-        else:
-            raise Exception("Invalid argument for calc_kickmap")
-    else:
-        cpp_mask = _auxiliary.Mask()._cppobj
+    cpp_mask = _get_cpp_mask(mask, "calc_kickmap")
+
+    if workers is not None and workers > 1 and cpp_grid.ny > 1:
+        x, y = list(cpp_grid.x), list(cpp_grid.y)
+        nr_chunks = min(len(y), 4*workers)
+        chunks = [list(c) for c in _numpy.array_split(range(len(y)), nr_chunks)]
+        state = (cpp_magnet, energy, x, y, zmin, zmax, rk_step, cpp_mask)
+        _profiling.count('kickmap_cells', len(x)*len(y))
+        with _profiling.phase('cpp_tracking'):
+            results = _utils._fork_map(_calc_kickmap_rows, state, chunks, workers)
+        for r in results:
+            _profiling.add_worker_stats(r[3])
+        id_length = results[0][0]
+        kick_x = _numpy.vstack([r[1] for r in results])
+        kick_y = _numpy.vstack([r[2] for r in results])
+        return _auxiliary.KickMap(id_length, x, y, kick_x, kick_y)
 
     cpp_kickmap = _idcpp.KickMap()
-    _idcpp.calc_kickmap(cpp_magnet, energy, cpp_grid, zmin, zmax, rk_step, cpp_mask, cpp_kickmap)
+    _profiling.count('kickmap_cells', cpp_grid.nx*cpp_grid.ny)
+    with _profiling.phase('cpp_tracking'):
+        _idcpp.calc_kickmap(cpp_magnet, energy, cpp_grid, zmin, zmax, rk_step, cpp_mask, cpp_kickmap)
     kickmap = _auxiliary.KickMap(kickmap=cpp_kickmap)
     return kickmap
+
+def _hash_arrays(h, *arrays):
+    for array in arrays:
+        array = _numpy.ascontiguousarray(array, dtype='<f8')
+        h.update(repr(array.shape).encode('utf-8'))
+        h.update(array.tobytes())
+
+def _magnet_digest(magnet):
+    # Digest of everything that determines the field of the magnet, or None
+    # for magnets whose geometry can not be described (e.g. field maps).
+    if isinstance(magnet, _auxiliary.CachedFieldMagnet):
+        digest = _magnet_digest(magnet.magnet)
+        if digest is None:
+            return None
+        h = _hashlib.sha256(('CachedFieldMagnet:' + digest).encode('utf-8'))
+        _hash_arrays(h, magnet.x, magnet.y, magnet.z)
+        return h.hexdigest()
+    if isinstance(magnet, _cassette.CassetteContainer):
+        cpp_cassettes = [magnet._cppobj.get_item(i) for i in range(magnet._cppobj.size())]
+    elif isinstance(magnet, _cassette.BlockContainer):
+        cpp_cassettes = [magnet._cppobj]
+    else:
+        return None
+    h = _hashlib.sha256(type(magnet).__name__.encode('utf-8'))
+    for cpp_cassette in cpp_cassettes:
+        mag, dim, pos = _cassette._block_arrays(cpp_cassette)
+        _hash_arrays(h, mag, dim, pos)
+        # the probe matrices change with the subvolumes of the blocks
+        g_cpp, g_box = _cassette._probe_gmatrices(_cassette._containers_blocks([cpp_cassette]), dim, pos)
+        _hash_arrays(h, g_cpp)
+        if isinstance(cpp_cassette, _idcpp.HalbachCassette):
+            h.update(repr((int(cpp_cassette.get_number_of_periods()),
+                           int(cpp_cassette.get_number_of_blocks_per_period()),
+                           float(cpp_cassette.get_block_separation()))).encode('utf-8'))
+            _hash_arrays(h, _utils._CppVector3D_to_vector(cpp_cassette.get_center_pos()))
+    if magnet._far_field is not None:
+        h.update(repr(('far_field', magnet._far_field.near_radius, magnet._far_field.tolerance)).encode('utf-8'))
+    if magnet._periodic_table is not None:
+        h.update(b'periodic')
+        _hash_arrays(h, magnet._periodic_table.x, magnet._periodic_table.y, magnet._periodic_table.z)
+    return h.hexdigest()
+
+def _mask_digest(mask):
+    if mask is None:
+        return 'NONE'
+    elif isinstance(mask, _auxiliary.Mask):
+        if mask.filename is not None:
+            with open(mask.filename, 'rb') as f:
+                return 'TABLE:' + _hashlib.sha256(f.read()).hexdigest()
+        return repr((mask.shape, float(mask.width), float(mask.height)))
+    return None
+
+def _kickmap_cache_key(magnet, energy, grid, zmin, zmax, rk_step, mask):
+    magnet_digest = _magnet_digest(magnet)
+    mask_digest = _mask_digest(mask)
+    if magnet_digest is None or mask_digest is None:
+        return None
+    if isinstance(grid, _auxiliary.Grid):
+        grid = grid._cppobj
+    h = _hashlib.sha256(b'calc_kickmap')
+    # a new idpy or idcpp version may change the integrator
+    h.update(repr((_idpy.__version__, getattr(_idcpp, '__version__', None))).encode('utf-8'))
+    h.update(repr((magnet_digest, mask_digest, float(energy), float(zmin), float(zmax), float(rk_step))).encode('utf-8'))
+    _hash_arrays(h, list(grid.x), list(grid.y))
+    return h.hexdigest()
+
+def calc_kickmap(magnet, energy, grid, zmin, zmax, rk_step, mask=None, workers=None, cache=None):
+    key = None
+    if cache is not None:
+        if not isinstance(cache, _auxiliary.KickMapCache):
+            cache = _auxiliary.KickMapCache(cache)
+        key = _kickmap_cache_key(magnet, energy, grid, zmin, zmax, rk_step, mask)
+        if key is not None:
+            kickmap = cache.get(key)
+            if kickmap is not None:
+                # same kind of KickMap as a computed one, not a read-only memmap
+                return _auxiliary.KickMap(kickmap=kickmap)
+
+    kickmap = _calc_kickmap(magnet, energy, grid, zmin, zmax, rk_step, mask, workers)
+
+    if key is not None:
+        provenance = {'magnet': type(magnet).__name__, 'energy': float(energy),
+                      'zmin': float(zmin), 'zmax': float(zmax), 'rk_step': float(rk_step)}
+        cache.put(key, kickmap, provenance)
+    return kickmap
+
+
+# Dormand-Prince 5(4) tableau
+_DP_C = (0.0, 1/5, 3/10, 4/5, 8/9, 1.0, 1.0)
+_DP_A = ((),
+         (1/5,),
+         (3/40, 9/40),
+         (44/45, -56/15, 32/9),
+         (19372/6561, -25360/2187, 64448/6561, -212/729),
+         (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+         (35/384, 0.0, 500/1113, 125/192, -2187/6784, 11/84))
+_DP_E = (71/57600, 0.0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40)
+
+
+def _get_magnet(magnet, function_name):
+    if isinstance(magnet, _auxiliary.Magnet):
+        return magnet
+    elif isinstance(magnet, _idcpp.Magnet):
+        m = _auxiliary.Magnet()
+        m._cppobj = magnet
+        return m
+    else:
+        raise Exception("Invalid argument for " + function_name)
+
+@_profiling.phased('rk_stepping')
+def _track(magnet, brho, R, P, zmax, step, cpp_mask, rtol=None, atol=None, max_step=None, trajectory=None):
+    # State of each particle is [x, y, px, py, pz] with z as the independent
+    # variable and p the unit vector along the momentum of an electron.
+    # Without rtol every step of size 'step' is accepted (fixed-step mode).
+    nr_evaluations = [0]
+
+    def derivative(z, s):
+        pos = _numpy.empty((len(s), 3))
+        pos[:,0], pos[:,1], pos[:,2] = s[:,0], s[:,1], z
+        with _profiling.phase('field'):
+            field = _numpy.atleast_2d(magnet.field(pos))
+        nr_evaluations[0] += len(s)
+        p, pz = s[:,2:5], s[:,4:5]
+        ds = _numpy.empty(s.shape)
+        ds[:,0:2] = p[:,0:2]/pz
+        ds[:,2:5] = -_numpy.cross(p, field)/(brho*pz)
+        return ds
+
+    z = R[0,2]
+    if _numpy.any(R[:,2] != z):
+        raise Exception("All particles must start at the same longitudinal position")
+    p0 = P/_numpy.linalg.norm(P, axis=1)[:,None]
+    state = _numpy.hstack([R[:,0:2], p0])
+    final = state.copy()
+    lost = _numpy.zeros(len(R), dtype=bool)
+    active = _numpy.arange(len(R))
+
+    adaptive = rtol is not None
+    if adaptive:
+        zmin_magnet, zmax_magnet = magnet.zmin, magnet.zmax
+        breakpoints = [zb for zb in (zmin_magnet, zmax_magnet) if z < zb < zmax] + [zmax]
+        if max_step is None:
+            # a zero-length magnet gives no scale, the step or the interval is used
+            length = zmax_magnet - zmin_magnet
+            max_step = length/20.0 if length > 0 else (step if step is not None else zmax - z)
+        h = min(step, max_step) if step is not None else max_step/100.0
+    else:
+        breakpoints, max_step, h = [zmax], step, step
+    if zmax > z and not h > 0:
+        raise Exception("Integration step must be positive")
+
+    if trajectory is not None:
+        trajectory.append([state[0,0], state[0,1], z] + list(state[0,2:5]))
+
+    s = state
+    k1 = derivative(z, s)
+    for zend in breakpoints:
+        while z < zend and len(active) > 0:
+            h = min(h, max_step, zend - z)
+            k = [k1]
+            for c, a in zip(_DP_C[1:], _DP_A[1:]):
+                si = s + h*sum(ai*ki for ai, ki in zip(a, k) if ai != 0.0)
+                k.append(derivative(z + c*h, si))
+            s_new = si
+            if adaptive:
+                error = h*sum(e*ki for e, ki in zip(_DP_E, k) if e != 0.0)
+                scale = atol + rtol*_numpy.maximum(_numpy.abs(s), _numpy.abs(s_new))
+                err = _numpy.max(_numpy.sqrt(_numpy.mean((error/scale)**2, axis=1)))
+            else:
+                err = 1.0
+            if err <= 1.0:
+                z = zend if h == zend - z else z + h
+                s, k1 = s_new, k[-1]
+                _profiling.count('rk_steps')
+                if cpp_mask is not None:
+                    with _profiling.phase('mask'):
+                        inside = _auxiliary._mask_contains(cpp_mask, s[:,0:2])
+                    if not _numpy.all(inside):
+                        lost[active[~inside]] = True
+                        active, s, k1 = active[inside], s[inside], k1[inside]
+                if trajectory is not None and len(active) > 0:
+                    trajectory.append([s[0,0], s[0,1], z] + list(s[0,2:5]))
+                if not adaptive:
+                    continue
+                factor = 5.0 if err == 0.0 else min(5.0, max(0.2, 0.9*err**-0.2))
+            else:
+                _profiling.count('rk_rejected_steps')
+                factor = max(0.2, 0.9*err**-0.2)
+                if h*factor < 1e-12*max(1.0, abs(z)):
+                    raise Exception("Step size too small in adaptive integration")
+            h = h*factor
+
+    final[active] = s
+    _profiling.count('particles', len(R))
+    kicks = (brho**2)*(final[:,2:5] - p0)
+    kicks[lost] = _numpy.nan
+    return kicks, nr_evaluations[0]
+
+def runge_kutta_adaptive(magnet, energy, r, p, zmax, rtol=1e-8, atol=1e-12, step=None, max_step=None, mask=None, trajectory_flag=False):
+    magnet = _get_magnet(magnet, "runge_kutta_adaptive")
+    cpp_mask = None if mask is None else _get_cpp_mask(mask, "runge_kutta_adaptive")
+    brho, beta = calc_brho(energy)
+    R = _utils._vector_array([r])
+    P = _utils._vector_array([p])
+    trajectory = [] if trajectory_flag else None
+    kicks, nr_evaluations = _track(magnet, brho, R, P, zmax, step, cpp_mask, rtol, atol, max_step, trajectory)
+    if trajectory_flag:
+        return _numpy.array(trajectory), nr_evaluations
+    else:
+        return kicks[0], nr_evaluations
+
+def _track_kickmap_rows(state, rows):
+    start = _time.perf_counter()
+    magnet, brho, x, y, zmin, zmax, step, cpp_mask, rtol, atol, max_step = state
+    X, Y = _numpy.meshgrid(x, y[rows])
+    R = _numpy.column_stack([X.ravel(), Y.ravel(), _numpy.full(X.size, zmin)])
+    P = _numpy.zeros((X.size, 3))
+    P[:,2] = 1.0
+    kicks, nr_evaluations = _track(magnet, brho, R, P, zmax, step, cpp_mask, rtol, atol, max_step)
+    stats = _profiling.worker_stats(start, rows=len(rows), cells=X.size)
+    return kicks[:,0].reshape(X.shape), kicks[:,1].reshape(X.shape), nr_evaluations, stats
+
+def _calc_kickmap_python(magnet, energy, grid, zmin, zmax, step, mask, rtol=None, atol=None, max_step=None, workers=None):
+    magnet = _get_magnet(magnet, "calc_kickmap")
+    if isinstance(grid, _auxiliary.Grid):
+        cpp_grid = grid._cppobj
+    elif isinstance(grid, _idcpp.Grid):
+        cpp_grid = grid
+    else:
+        raise Exception("Invalid argument for calc_kickmap")
+    cpp_mask = None if mask is None else _get_cpp_mask(mask, "calc_kickmap")
+    brho, beta = calc_brho(energy)
+
+    # With workers the rows are tracked in forked processes. In adaptive mode
+    # each chunk of rows chooses its own steps.
+    x, y = _numpy.array(list(cpp_grid.x)), _numpy.array(list(cpp_grid.y))
+    state = (magnet, brho, x, y, zmin, zmax, step, cpp_mask, rtol, atol, max_step)
+    if workers is not None and workers > 1 and len(y) > 1:
+        chunks = [c for c in _numpy.array_split(_numpy.arange(len(y)), min(len(y), 4*workers))]
+    else:
+        chunks = [_numpy.arange(len(y))]
+    results = _utils._fork_map(_track_kickmap_rows, state, chunks, workers)
+    if len(chunks) > 1:
+        for r in results:
+            _profiling.add_worker_stats(r[3])
+    kick_x = _numpy.vstack([r[0] for r in results])
+    kick_y = _numpy.vstack([r[1] for r in results])
+    nr_evaluations = sum(r[2] for r in results)
+    kickmap = _auxiliary.KickMap(magnet.physical_length, x, y, kick_x, kick_y)
+    return kickmap, nr_evaluations
+
+def calc_kickmap_adaptive(magnet, energy, grid, zmin, zmax, rtol=1e-8, atol=1e-12, step=None, max_step=None, mask=None, workers=None):
+    return _calc_kickmap_python(magnet, energy, grid, zmin, zmax, step, mask, rtol, atol, max_step, workers)
@@ -10,8 +10,61 @@ class IDModelException(Exception):
     pass
 
 
+def _epu_cpp_cassettes(cpp_epu):
+    return [cpp_epu.get_csd(), cpp_epu.get_cse(), cpp_epu.get_cid(), cpp_epu.get_cie()]
+
+def _table_axis(axis, centers):
+    # Axis in the frame of a cassette covering 'axis' for every cassette centre.
+    axis = _numpy.asarray(axis, dtype=float)
+    step = axis[1] - axis[0] if len(axis) > 1 else 1e-3
+    lo = axis.min() - max(centers) - step
+    hi = axis.max() - min(centers) + step
+    nr_pts = max(int(_numpy.ceil((hi - lo)/step)) + 1, 4)
+    return lo + step*_numpy.arange(nr_pts)
+
+
+class _CassetteTableSum(_auxiliary.Magnet):
+
+    # Field of the EPU as the sum of the field tables of its cassettes,
+    # computed once in the frame of each cassette and translated to the
+    # current cassette centres.
+
+    _python_field = True
+
+    def __init__(self, epu, tables):
+        self._cppobj = epu._cppobj
+        self._tables = tables
+
+    def field(self, pos, workers=None):
+        if workers is not None and workers > 1 and _numpy.ndim(pos) > 1:
+            return _auxiliary._parallel_field(self.field, pos, workers)
+        positions = _numpy.atleast_2d(_numpy.asarray(pos, dtype=_numpy.float64))
+        field = _numpy.zeros(positions.shape)
+        for cpp_cassette, table in zip(_epu_cpp_cassettes(self._cppobj), self._tables):
+            center = _utils._CppVector3D_to_vector(cpp_cassette.get_center_pos())
+            field += table.field(positions - center)
+        return field[0] if _numpy.ndim(pos) == 1 else field
+
+
+def _apply_setting(epu, setting):
+    gap, phase_csd, phase_cie = setting
+    epu.magnetic_gap = gap
+    epu.set_phase_csd(phase_csd)
+    epu.set_phase_cie(phase_cie)
+
+def _scan_settings(state, settings):
+    epu, function, magnet = state
+    results = []
+    for setting in settings:
+        _apply_setting(epu, setting)
+        results.append(function(magnet))
+    return results
+
+
 class EPU(_cassette.CassetteContainer):
 
+    _faces = None
+
     def __init__(self, block, nr_periods, magnetic_gap, _cassette_separation, block_separation=0.0, phase_csd=0.0, phase_cie=0.0, epu=None):
         if epu is not None:
             if isinstance(epu, EPU):
@@ -51,16 +104,95 @@ class EPU(_cassette.CassetteContainer):
 
     def set_phase_csd(self, phase):
         self._cppobj.get_csd().set_zcenter(phase)
+        self._update_field_models()
 
     def set_phase_cie(self, phase):
         self._cppobj.get_cie().set_zcenter(phase)
+        self._update_field_models()
+
+    @property
+    def phase_csd(self):
+        return _utils._CppVector3D_to_vector(self._cppobj.get_csd().get_center_pos())[2]
+
+    @property
+    def phase_cie(self):
+        return _utils._CppVector3D_to_vector(self._cppobj.get_cie().get_center_pos())[2]
+
+    def _gap_faces(self):
+        # y offset from the centre of each cassette to its face at the gap,
+        # which does not change when the cassettes are moved
+        if self._faces is None:
+            faces = []
+            for i, cpp_cassette in enumerate(_epu_cpp_cassettes(self._cppobj)):
+                mag, dim, pos = _cassette._block_arrays(cpp_cassette)
+                ycenter = _utils._CppVector3D_to_vector(cpp_cassette.get_center_pos())[1]
+                face = _numpy.min(pos[:,1] - dim[:,1]/2) if i < 2 else _numpy.max(pos[:,1] + dim[:,1]/2)
+                faces.append(face - ycenter)
+            self._faces = faces
+        return self._faces
+
+    @property
+    def magnetic_gap(self):
+        ycenters = [_utils._CppVector3D_to_vector(c.get_center_pos())[1] for c in _epu_cpp_cassettes(self._cppobj)]
+        faces = [y + face for y, face in zip(ycenters, self._gap_faces())]
+        return min(faces[:2]) - max(faces[2:])
+
+    @magnetic_gap.setter
+    def magnetic_gap(self, gap):
+        shift = (gap - self.magnetic_gap)/2.0
+        for i, cpp_cassette in enumerate(_epu_cpp_cassettes(self._cppobj)):
+            ycenter = _utils._CppVector3D_to_vector(cpp_cassette.get_center_pos())[1]
+            cpp_cassette.set_ycenter(ycenter + shift if i < 2 else ycenter - shift)
+        self._update_field_models()
+
+    def scan(self, function, gaps=None, phases_csd=None, phases_cie=None, field_grid=None, workers=None):
+        if gaps is None: gaps = [self.magnetic_gap]
+        if phases_csd is None: phases_csd = [self.phase_csd]
+        if phases_cie is None: phases_cie = [self.phase_cie]
+        settings = [(float(g), float(pd), float(pe)) for g in gaps for pd in phases_csd for pe in phases_cie]
+
+        # settings are applied to a copy, the cassettes of self are not moved
+        epu = EPU(None, None, None, None, epu=self)
+        magnet = epu
+        if field_grid is not None:
+            centers = [[] for i in range(4)]
+            for setting in settings:
+                _apply_setting(epu, setting)
+                for i, cpp_cassette in enumerate(_epu_cpp_cassettes(epu._cppobj)):
+                    centers[i].append(_utils._CppVector3D_to_vector(cpp_cassette.get_center_pos()))
+            tables = []
+            for i, cpp_cassette in enumerate(_epu_cpp_cassettes(epu._cppobj)):
+                cassette = _cassette.HalbachCassette(halbachcassette=cpp_cassette)
+                cassette.center_pos = [0.0, 0.0, 0.0]
+                c = _numpy.array(centers[i])
+                axes = [_table_axis(field_grid[k], c[:,k]) for k in range(3)]
+                lazy = workers is None or workers <= 1
+                tables.append(_auxiliary.CachedFieldMagnet(cassette, *axes, lazy=lazy))
+            magnet = _CassetteTableSum(epu, tables)
+
+        chunks = [list(c) for c in _numpy.array_split(settings, min(len(settings), 4*(workers or 1))) if len(c)]
+        results = [r for chunk in _utils._fork_map(_scan_settings, (epu, function, magnet), chunks, workers) for r in chunk]
+
+        if not isinstance(results[0], dict):
+            results = [{'value': r} for r in results]
+        names = list(results[0].keys())
+        if set(names) & {'gap', 'phase_csd', 'phase_cie'}:
+            raise IDModelException("Result names must differ from gap, phase_csd and phase_cie")
+        dtype = [('gap', 'f8'), ('phase_csd', 'f8'), ('phase_cie', 'f8')]
+        dtype += [(name, 'f8', _numpy.shape(results[0][name])) for name in names]
+        table = _numpy.recarray(len(settings), dtype=dtype)
+        for i, (setting, result) in enumerate(zip(settings, results)):
+            table.gap[i], table.phase_csd[i], table.phase_cie[i] = setting
+            for name in names:
+                table[name][i] = result[name]
+        return table
 
 
 
 class DELTA(_cassette.CassetteContainer):
 
     def __init__(self, block, nr_periods, vertical_gap, horizontal_gap, block_separation=0.0, phase_cd=0.0, phase_ce=0.0, delta=None):
-        if epu is not None:
+        if delta is not None:
             if isinstance(delta, DELTA):
                 self._cppobj = _idcpp.DELTA(delta._cppobj)
             elif isinstance(delta, _idcpp.DELTA):
@@ -98,6 +230,8 @@ class DELTA(_cassette.CassetteContainer):
 
     def set_phase_cd(self, phase):
         self._cppobj.get_cd().set_zcenter(phase)
+        self._update_field_models()
 
     def set_phase_ce(self, phase):
         self._cppobj.get_ce().set_zcenter(phase)
+        self._update_field_models()
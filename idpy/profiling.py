@@ -0,0 +1,143 @@
+import collections as _collections
+import contextlib as _contextlib
+import functools as _functools
+import json as _json
+import os as _os
+import time as _time
+
+
+_active = None
+
+
+class Profile(object):
+
+    def __init__(self):
+        self.counters = _collections.defaultdict(int)
+        self.timings = _collections.defaultdict(float)
+        self.workers = []
+        self.wall_time = 0.0
+        self._stack = []
+        self._pid = _os.getpid()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def _enter(self, name):
+        now = _time.perf_counter()
+        if self._stack:
+            # phase times are exclusive, the enclosing phase is paused
+            parent, start = self._stack[-1]
+            self.timings[parent] += now - start
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = _time.perf_counter()
+        name, start = self._stack.pop()
+        self.timings[name] += now - start
+        if self._stack:
+            self._stack[-1][1] = now
+
+    @_contextlib.contextmanager
+    def phase(self, name):
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def as_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'counters': dict(self.counters),
+            'timings': dict(self.timings),
+            'workers': list(self.workers),
+        }
+
+    def to_json(self, filename=None):
+        text = _json.dumps(self.as_dict(), indent=1, sort_keys=True)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(text)
+        return text
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+_null_phase = _NullPhase()
+
+
+def phase(name):
+    if _active is None:
+        return _null_phase
+    return _active.phase(name)
+
+def phased(name):
+    def decorator(function):
+        @_functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with _active.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    if _active is not None:
+        _active.counters[name] += n
+
+def count_field(nr_points, vector=True):
+    if _active is not None:
+        _active.counters['field_vector_calls' if vector else 'field_calls'] += 1
+        _active.counters['field_points'] += nr_points
+
+def _reset_after_fork():
+    # A forked worker starts with empty counters and phases, so that what
+    # it records can be sent back to the parent without counting twice.
+    if _active is not None:
+        _active.counters.clear()
+        _active.timings.clear()
+        _active.workers = []
+        _active._stack = []
+
+if hasattr(_os, 'register_at_fork'):
+    _os.register_at_fork(after_in_child=_reset_after_fork)
+
+def worker_stats(start, **stats):
+    # Statistics of a worker, returned to the parent with the results. In a
+    # forked worker the counters and phase times recorded since the last
+    # call are moved into the statistics.
+    if _active is None:
+        return None
+    stats.update({'pid': _os.getpid(), 'time': _time.perf_counter() - start})
+    if _os.getpid() != _active._pid:
+        stats['counters'], stats['timings'] = dict(_active.counters), dict(_active.timings)
+        _active.counters.clear()
+        _active.timings.clear()
+    return stats
+
+def add_worker_stats(stats):
+    # Counters of forked workers are added to the ones of the parent, their
+    # phase times overlap the parent phases and are kept with each worker.
+    if _active is not None and stats is not None:
+        _active.workers.append(stats)
+        for name, n in stats.get('counters', {}).items():
+            _active.counters[name] += n
+
+@_contextlib.contextmanager
+def profile():
+    global _active
+    previous = _active
+    _active = Profile()
+    start = _time.perf_counter()
+    try:
+        yield _active
+    finally:
+        _active.wall_time = _time.perf_counter() - start
+        _active = previous
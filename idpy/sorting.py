@@ -0,0 +1,150 @@
+import numpy as _numpy
+import idpy.utils as _utils
+import idpy.cassette as _cassette
+
+
+class SortingException(Exception):
+    pass
+
+
+def integral_operator(z):
+    return _cassette._line_integral_operator(z)
+
+def _slot_rotations(mag):
+    # Rotation of each slot taking the block frame to the cassette frame. The
+    # block frame has z along the nominal magnetization of the slot (the easy
+    # axis), x along the cassette x axis made perpendicular to z, or along
+    # the cassette y axis when the easy axis is within about 25 degrees of x,
+    # and y = z cross x.
+    ex, ey = _numpy.array([1.0, 0.0, 0.0]), _numpy.array([0.0, 1.0, 0.0])
+    rotations = _numpy.empty((len(mag), 3, 3))
+    for s, m in enumerate(mag):
+        c3 = m/_numpy.linalg.norm(m)
+        ref = ex if abs(c3.dot(ex)) < 0.9 else ey
+        c1 = ref - ref.dot(c3)*c3
+        c1 /= _numpy.linalg.norm(c1)
+        rotations[s] = _numpy.column_stack([c1, _numpy.cross(c3, c1), c3])
+    return rotations
+
+def _anneal_chain(sorter, args):
+    seed, nr_iterations, initial, temperatures = args
+    return sorter.anneal(nr_iterations, temperatures, seed=seed, initial=initial)
+
+
+class BlockSorter(object):
+
+    # blocks are the measured magnetizations of the blocks in the block frame
+    # of _slot_rotations: z is the easy axis, x is the cassette x axis (the
+    # cassette y axis for slots magnetized along x) and y = z cross x. A block
+    # placed in a slot keeps its components in that frame.
+
+    def __init__(self, cassette, blocks, points, operator=None, target=None, weights=None):
+        mag, dim, pos = _cassette._block_arrays(cassette._cppobj)
+        self._cassette = cassette
+        self._blocks = _numpy.asarray(blocks, dtype=float)
+        self.nr_slots, self.nr_blocks = len(mag), len(self._blocks)
+        if self.nr_blocks < self.nr_slots:
+            raise SortingException("Not enough blocks for the slots of the cassette")
+        self._rotations = _slot_rotations(mag)
+
+        # response of each slot to a block magnetization in the block frame
+        points = _utils._vector_array(points)
+        response = _numpy.empty((self.nr_slots, 3*len(points), 3))
+        cpp_blocks = _cassette._containers_blocks([cassette._cppobj])
+        irregular = _cassette._irregular_blocks(cpp_blocks, dim, pos)
+        for s in range(self.nr_slots):
+            g = _cassette._exact_gmatrices(cpp_blocks[s], points, pos[s], dim[s], irregular[s])
+            response[s] = g.dot(self._rotations[s]).reshape(-1, 3)
+        if operator is not None:
+            response = _numpy.einsum('ij,sjk->sik', operator, response)
+        if weights is not None:
+            response *= _numpy.sqrt(_numpy.asarray(weights, dtype=float))[None,:,None]
+        self._response = response
+        if target is None:
+            target = _numpy.einsum('sij,sj->i', response, _numpy.einsum('sji,sj->si', self._rotations, mag))
+        elif weights is not None:
+            target = _numpy.asarray(target, dtype=float)*_numpy.sqrt(weights)
+        self._target = _numpy.asarray(target, dtype=float)
+        # H[s,t] = A_s^T A_t makes the cost change of a move independent of
+        # the number of observables.
+        self._gram = _numpy.einsum('sji,tjk->stik', response, response)
+
+    def observables(self, assignment):
+        return _numpy.einsum('sij,sj->i', self._response, self._blocks[assignment[:self.nr_slots]])
+
+    def cost(self, assignment):
+        residue = self.observables(assignment) - self._target
+        return residue.dot(residue)
+
+    def magnetizations(self, assignment):
+        return _numpy.einsum('sij,sj->si', self._rotations, self._blocks[assignment[:self.nr_slots]])
+
+    def apply(self, assignment, cassette=None):
+        cassette = self._cassette if cassette is None else cassette
+        cassette.set_block_arrays(mag=self.magnetizations(assignment))
+
+    def _temperatures(self, assignment, rng, nr_samples=200):
+        # initial temperature of the order of the typical cost change of a move
+        residue = self.observables(assignment) - self._target
+        g = _numpy.einsum('sji,j->si', self._response, residue)
+        deltas = []
+        for k in range(nr_samples):
+            i, j = rng.choice(self.nr_slots, 2, replace=False)
+            d = self._blocks[assignment[j]] - self._blocks[assignment[i]]
+            k_ij = self._gram[i,i] + self._gram[j,j] - self._gram[i,j] - self._gram[j,i]
+            deltas.append(abs(2*(g[i] - g[j]).dot(d) + d.dot(k_ij).dot(d)))
+        t0 = max(_numpy.median(deltas), 1e-300)
+        return t0, t0*1e-4
+
+    def anneal(self, nr_iterations=100000, temperatures=None, seed=None, initial=None):
+        rng = _numpy.random.default_rng(seed)
+        nr_slots, nr_blocks = self.nr_slots, self.nr_blocks
+        assignment = rng.permutation(nr_blocks) if initial is None else _numpy.array(initial)
+        if temperatures is None:
+            temperatures = self._temperatures(assignment, rng)
+        t0, t1 = temperatures
+        blocks, gram = self._blocks, self._gram
+
+        residue = self.observables(assignment) - self._target
+        cost = residue.dot(residue)
+        g = _numpy.einsum('sji,j->si', self._response, residue)
+        best_cost, best = cost, assignment.copy()
+
+        decay = (t1/t0)**(1.0/max(nr_iterations - 1, 1))
+        temperature = t0
+        moves = rng.integers(0, nr_blocks, (nr_iterations, 2))
+        uniforms = rng.random(nr_iterations)
+        for n in range(nr_iterations):
+            i, j = moves[n]
+            if i == j or i >= nr_slots:
+                temperature *= decay
+                continue
+            d = blocks[assignment[j]] - blocks[assignment[i]]
+            if j < nr_slots:
+                # swap of the blocks in slots i and j
+                k_ij = gram[i,i] + gram[j,j] - gram[i,j] - gram[j,i]
+                delta = 2*(g[i] - g[j]).dot(d) + d.dot(k_ij).dot(d)
+            else:
+                # block of slot i replaced by the spare block j
+                delta = 2*g[i].dot(d) + d.dot(gram[i,i]).dot(d)
+            if delta < 0 or uniforms[n] < _numpy.exp(-delta/temperature):
+                if j < nr_slots:
+                    g += _numpy.einsum('sik,k->si', gram[:,i] - gram[:,j], d)
+                else:
+                    g += _numpy.einsum('sik,k->si', gram[:,i], d)
+                assignment[i], assignment[j] = assignment[j], assignment[i]
+                cost += delta
+                if cost < best_cost:
+                    best_cost, best = cost, assignment.copy()
+            temperature *= decay
+        return best, self.cost(best)
+
+    def optimize(self, nr_iterations=100000, nr_chains=1, workers=None, seed=None, initial=None):
+        # independent annealing chains, in parallel when workers > 1
+        seeds = _numpy.random.SeedSequence(seed).spawn(nr_chains)
+        rng = _numpy.random.default_rng(seeds[0])
+        start = rng.permutation(self.nr_blocks) if initial is None else _numpy.array(initial)
+        temperatures = self._temperatures(start, rng)
+        args_list = [(s, nr_iterations, initial, temperatures) for s in seeds]
+        results = _utils._fork_map(_anneal_chain, self, args_list, workers)
+        return min(results, key=lambda r: r[1])
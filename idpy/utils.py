@@ -1,4 +1,5 @@
 
+import multiprocessing as _multiprocessing
 import numpy as _numpy
 import idcpp as _idcpp
 
@@ -16,20 +17,39 @@ def _vector_to_CppVector3D(vector):
     CppVector3D.z = float(v[2])
     return CppVector3D
 
+def _vector_array(matrix):
+    try:
+        m = _numpy.ascontiguousarray(matrix, dtype=_numpy.float64)
+    except (TypeError, ValueError):
+        raise UtilsException("Can't convert matrix to (N,3) array")
+    if m.ndim != 2 or m.shape[1] != 3:
+        raise UtilsException("Can't convert matrix to (N,3) array")
+    return m
+
 def _matrix_to_CppVectorVector3D(matrix):
-    m = _numpy.array(matrix)
-    if not isinstance(m[0], (list, tuple, _numpy.ndarray)) or len(m[0]) != 3:
+    try:
+        m = _vector_array(matrix)
+    except UtilsException:
         raise UtilsException("Can't convert matrix to CppVectorVector3D object")
+    # push_back copies its argument into the C++ vector, so a single
+    # CppVector3D is reused instead of creating one wrapper per point
+    # (tolist() still builds a small list for each point).
     CppVectorVector3D = _idcpp.CppVectorVector3D()
-    for i in range(len(m)):
-        CppVectorVector3D.push_back(_vector_to_CppVector3D(m[i]))
+    CppVectorVector3D.reserve(len(m))
+    CppVector3D = _idcpp.CppVector3D()
+    for x, y, z in m.tolist():
+        CppVector3D.x = x
+        CppVector3D.y = y
+        CppVector3D.z = z
+        CppVectorVector3D.push_back(CppVector3D)
     return CppVectorVector3D
 
 def _matrix_to_CppDoubleVectorVector(matrix):
-    m = _numpy.array(matrix)
+    m = _numpy.ascontiguousarray(matrix, dtype=_numpy.float64)
     CppDoubleVectorVector = _idcpp.CppDoubleVectorVector()
-    for i in range(len(m)):
-        CppDoubleVectorVector.push_back(_idcpp.CppDoubleVector(m[i]))
+    CppDoubleVectorVector.reserve(len(m))
+    for row in m.tolist():
+        CppDoubleVectorVector.push_back(_idcpp.CppDoubleVector(row))
     return CppDoubleVectorVector
 
 def _matrix_to_CppMatrix3D(matrix):
@@ -50,27 +70,72 @@ def _CppVector3D_to_vector(CppVector3D):
     vector = _numpy.array(v)
     return vector
 
-def _CppVectorVector3D_to_matrix(CppVectorVector3D):
-    m = []
-    for i in range(CppVectorVector3D.size()):
-        m.append(_CppVector3D_to_vector(CppVectorVector3D[i]))
-    matrix = _numpy.array(m)
-    return matrix
+def _CppVectorVector3D_to_matrix(CppVectorVector3D, out=None):
+    n = CppVectorVector3D.size()
+    if out is None:
+        out = _numpy.empty((n, 3), dtype=_numpy.float64)
+    elif out.shape != (n, 3):
+        raise UtilsException("Invalid output array for CppVectorVector3D conversion")
+    values = (c for v in CppVectorVector3D for c in (v.x, v.y, v.z))
+    out[...] = _numpy.fromiter(values, dtype=_numpy.float64, count=3*n).reshape(n, 3)
+    return out
+
+def _CppDoubleVector_to_vector(CppDoubleVector):
+    return _numpy.fromiter(CppDoubleVector, dtype=_numpy.float64, count=CppDoubleVector.size())
 
 def _CppDoubleVectorVector_to_matrix(CppDoubleVectorVector):
-    m = []
-    for i in range(CppDoubleVectorVector.size()):
-        m.append(_numpy.array(CppDoubleVectorVector[i]))
-    matrix = _numpy.array(m)
-    return matrix
+    nrows = CppDoubleVectorVector.size()
+    ncols = CppDoubleVectorVector[0].size() if nrows > 0 else 0
+    values = (c for row in CppDoubleVectorVector for c in row)
+    matrix = _numpy.fromiter(values, dtype=_numpy.float64, count=nrows*ncols)
+    return matrix.reshape(nrows, ncols)
 
 def _CppMatrix3D_to_matrix(CppMatrix3D):
     m = []
     for i in range(3):
-        m.append(_CppVector3D_to_vector(CppMatrix3D.row(i)))
+        row = CppMatrix3D.row(i)
+        m.append((row.x, row.y, row.z))
     matrix = _numpy.array(m)
     return matrix
 
+_fork_task = None
+
+def _fork_init(function, state):
+    # Runs once in each worker. With the fork start method the initializer
+    # arguments are inherited, not pickled, and the parent keeps no global.
+    global _fork_task
+    _fork_task = (function, state)
+
+def _fork_worker(args):
+    function, state = _fork_task
+    return function(state, args)
+
+def _fork_serial(args_list, workers):
+    # Pool workers are daemonic and can't start pools of their own, so
+    # parallel calls nested in a worker run serially.
+    return (workers is None or workers <= 1 or len(args_list) <= 1 or
+            _multiprocessing.current_process().daemon)
+
+def _fork_map(function, state, args_list, workers=None):
+    # idcpp objects can't be pickled, so workers are forked and inherit
+    # 'state' from the parent instead of receiving it through the pool.
+    if _fork_serial(args_list, workers):
+        return [function(state, args) for args in args_list]
+    context = _multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(args_list)), _fork_init, (function, state)) as pool:
+        return pool.map(_fork_worker, args_list)
+
+def _fork_imap(function, state, args_list, workers=None):
+    # Like _fork_map, but yields the results as the workers finish them.
+    if _fork_serial(args_list, workers):
+        for args in args_list:
+            yield function(state, args)
+        return
+    context = _multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(args_list)), _fork_init, (function, state)) as pool:
+        for result in pool.imap_unordered(_fork_worker, args_list):
+            yield result
+
 def get_rotation_matrix_x(angle):
     I = _idcpp.CppMatrix3D.I()
     I.set_rotation_x(angle)
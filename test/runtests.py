@@ -3,10 +3,20 @@
 import unittest
 import test_utils
 import test_cassette
+import test_auxiliary
+import test_idmodel
+import test_fieldmap
+import test_sorting
+import test_functions
 
 suite_list = []
 suite_list.append(test_utils.get_suite())
 suite_list.append(test_cassette.get_suite())
+suite_list.append(test_auxiliary.get_suite())
+suite_list.append(test_idmodel.get_suite())
+suite_list.append(test_fieldmap.get_suite())
+suite_list.append(test_sorting.get_suite())
+suite_list.append(test_functions.get_suite())
 
 tests = unittest.TestSuite(suite_list)
 unittest.TextTestRunner(verbosity=2).run(tests)
@@ -0,0 +1,208 @@
+
+import os
+import tempfile
+import unittest
+import numpy
+import idcpp
+import idpy
+
+class TestCachedFieldMagnet(unittest.TestCase):
+
+    def setUp(self):
+        mag = [0,1.45,0]
+        dim = [0.06,0.06,0.01]
+        rot = idpy.utils.rotx90p
+        block = idpy.cassette.Block(mag, dim, [0,0.04,0])
+        self.magnet = idpy.cassette.HalbachCassette(block, rot, 2)
+        self.x = numpy.linspace(-0.01, 0.01, 11)
+        self.y = numpy.linspace(-0.005, 0.005, 6)
+        self.z = numpy.linspace(-0.05, 0.13, 181)
+
+    def test_field_at_nodes(self):
+        cached = idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z)
+        pos = [self.x[3], self.y[2], self.z[50]]
+        field = cached.field(pos)
+        exact = self.magnet.field(pos)
+        for i in range(3):
+            self.assertAlmostEqual(field[i], exact[i], places=12)
+
+    def test_field_interpolation(self):
+        cached = idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z)
+        pos = numpy.random.RandomState(0).uniform([-0.01,-0.005,-0.05], [0.01,0.005,0.13], (50,3))
+        error = cached.error_estimate(pos)
+        bound = cached.error_bound()
+        for i in range(3):
+            self.assertLess(error[i], bound[i] + 1e-12)
+        self.assertEqual(cached.field(pos).shape, (50,3))
+
+    def test_lazy_tiles(self):
+        cached = idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z, lazy=True, tile_size=8)
+        self.assertEqual(cached.nr_samples, 0)
+        field = cached.field([0.0, 0.0, 0.0])
+        self.assertGreater(cached.nr_samples, 0)
+        self.assertLess(cached.nr_samples, len(self.x)*len(self.y)*len(self.z))
+        exact = self.magnet.field([0.0, 0.0, 0.0])
+        for i in range(3):
+            self.assertAlmostEqual(field[i], exact[i], places=6)
+
+    def test_out_of_grid(self):
+        cached = idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z, lazy=True)
+        with self.assertRaises(Exception):
+            cached.field([0.0, 0.0, 1.0])
+
+    def test_tile_size(self):
+        with self.assertRaises(Exception):
+            idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z, lazy=True, tile_size=3)
+        cached = idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z, lazy=True, tile_size=4)
+        pos = numpy.random.RandomState(1).uniform([-0.01,-0.005,-0.05], [0.01,0.005,0.13], (20,3))
+        full = idpy.auxiliary.CachedFieldMagnet(self.magnet, self.x, self.y, self.z)
+        numpy.testing.assert_array_equal(cached.field(pos), full.field(pos))
+
+
+class TestKickMap(unittest.TestCase):
+
+    def setUp(self):
+        self.x = numpy.linspace(-0.012, 0.012, 7)
+        self.y = numpy.linspace(-0.004, 0.004, 5)
+        self.kick_x = numpy.outer(self.y, self.x)*1e3
+        self.kick_y = numpy.outer(self.y**2, self.x)*1e5
+        self.kick_x[0,3] = numpy.nan
+        self.kickmap = idpy.auxiliary.KickMap(2.5, self.x, self.y, self.kick_x, self.kick_y)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'kickmap.txt')
+
+    def test_write_to_file_format(self):
+        self.kickmap.write_to_file(self.filename)
+        with open(self.filename) as f:
+            lines = f.read().split('\n')
+        self.assertEqual(lines[0], '# KICKMAP')
+        self.assertEqual(lines[3], '2.5')
+        self.assertEqual(lines[5], '7')
+        self.assertEqual(lines[7], '5')
+        self.assertEqual(lines[9], 'START')
+        self.assertEqual(lines[10], ' '*13 + ''.join('%+e ' % v for v in self.x))
+        self.assertEqual(lines[11][:14], '%+e ' % self.y[0])
+        self.assertIn('+nan' + ' '*9 + ' ', lines[11])
+        self.assertEqual(lines[18], ' '*14 + ''.join('%+e ' % v for v in self.x))
+
+    def test_read_from_file(self):
+        self.kickmap.write_to_file(self.filename)
+        kickmap = idpy.auxiliary.KickMap.read_from_file(self.filename)
+        self.assertEqual(kickmap.id_length, 2.5)
+        self.assertTrue(numpy.allclose(kickmap.x, self.x))
+        self.assertTrue(numpy.allclose(kickmap.y, self.y))
+        self.assertTrue(numpy.isnan(kickmap.kick_x[0,3]))
+        self.assertTrue(numpy.allclose(kickmap.kick_x, self.kick_x, rtol=1e-6, equal_nan=True))
+        self.assertTrue(numpy.allclose(kickmap.kick_y, self.kick_y, rtol=1e-6))
+
+    def test_binary_save_load(self):
+        filename = os.path.join(os.path.dirname(self.filename), 'kickmap.bin')
+        self.kickmap.save(filename, provenance={'device': 'test'})
+        kickmap = idpy.auxiliary.KickMap.load(filename)
+        self.assertIsInstance(kickmap.kick_x, numpy.memmap)
+        self.assertFalse(kickmap.kick_x.flags.writeable)
+        self.assertEqual(kickmap.id_length, 2.5)
+        self.assertEqual(kickmap.header['nx'], 7)
+        self.assertEqual(kickmap.header['ny'], 5)
+        self.assertEqual(kickmap.header['provenance']['device'], 'test')
+        self.assertTrue(numpy.array_equal(kickmap.x, self.x))
+        self.assertTrue(numpy.array_equal(kickmap.y, self.y))
+        self.assertTrue(numpy.array_equal(kickmap.kick_x, self.kick_x, equal_nan=True))
+        self.assertTrue(numpy.array_equal(kickmap.kick_y, self.kick_y))
+        copy = idpy.auxiliary.KickMap(kickmap=kickmap)
+        self.assertTrue(numpy.array_equal(copy.kick_y, self.kick_y))
+
+    def test_binary_text_conversion(self):
+        binary_filename = os.path.join(os.path.dirname(self.filename), 'kickmap.bin')
+        text_filename = os.path.join(os.path.dirname(self.filename), 'converted.txt')
+        self.kickmap.write_to_file(self.filename)
+        idpy.auxiliary.KickMap.text_to_binary(self.filename, binary_filename)
+        idpy.auxiliary.KickMap.binary_to_text(binary_filename, text_filename)
+        with open(self.filename) as f1, open(text_filename) as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+
+    def test_apply_mask(self):
+        mask = idpy.auxiliary.Mask("RECTANGLE", 0.016, 0.006)
+        inside = numpy.array([[mask.is_inside([xi, yi, 0.0]) for xi in self.x] for yi in self.y])
+        points = numpy.column_stack([numpy.tile(self.x, len(self.y)), numpy.repeat(self.y, len(self.x))])
+        self.assertTrue(numpy.array_equal(mask.contains(points), inside.ravel()))
+        self.kickmap.apply_mask(mask)
+        kick_x = numpy.where(inside, self.kick_x, numpy.nan)
+        kick_y = numpy.where(inside, self.kick_y, numpy.nan)
+        numpy.testing.assert_array_equal(self.kickmap.kick_x, kick_x)
+        numpy.testing.assert_array_equal(self.kickmap.kick_y, kick_y)
+
+    def test_pass_through_mask(self):
+        mask = idpy.auxiliary.Mask("ELLIPSE", 0.02, 0.006)
+        self.kickmap.write_to_file(self.filename)
+        output_filename = self.filename + '.masked'
+        idpy.auxiliary.KickMap.pass_through_mask(self.filename, output_filename, mask)
+        self.kickmap.apply_mask(mask)
+        kickmap = idpy.auxiliary.KickMap.read_from_file(output_filename)
+        numpy.testing.assert_allclose(kickmap.kick_x, self.kickmap.kick_x)
+        numpy.testing.assert_allclose(kickmap.kick_y, self.kickmap.kick_y)
+
+
+class TestKickMapCache(unittest.TestCase):
+
+    def setUp(self):
+        x = numpy.linspace(-0.012, 0.012, 7)
+        y = numpy.linspace(-0.004, 0.004, 5)
+        self.kickmaps = [idpy.auxiliary.KickMap(2.5, x, y, numpy.full((5,7), i), numpy.full((5,7), -i)) for i in range(3)]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = idpy.auxiliary.KickMapCache(directory.name)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', self.kickmaps[1])
+        self.assertTrue('key' in self.cache)
+        kickmap = self.cache.get('key')
+        numpy.testing.assert_array_equal(kickmap.kick_x, self.kickmaps[1].kick_x)
+        numpy.testing.assert_array_equal(kickmap.kick_y, self.kickmaps[1].kick_y)
+
+    def test_corrupt_entry(self):
+        self.cache.put('key', self.kickmaps[1])
+        with open(self.cache._path('key'), 'r+b') as f:
+            f.truncate(os.path.getsize(self.cache._path('key')) - 8)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse('key' in self.cache)
+        with open(self.cache._path('key'), 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', self.kickmaps[2])
+        numpy.testing.assert_array_equal(self.cache.get('key').kick_x, self.kickmaps[2].kick_x)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', self.kickmaps[0])
+        self.cache.max_size = 2*self.cache.size
+        self.cache.put('b', self.kickmaps[1])
+        os.utime(self.cache._path('a'), (0, 0))
+        os.utime(self.cache._path('b'), (1, 1))
+        self.cache.get('a')
+        self.cache.put('c', self.kickmaps[2])
+        self.assertTrue('a' in self.cache)
+        self.assertFalse('b' in self.cache)
+        self.assertTrue('c' in self.cache)
+
+
+def cached_field_magnet_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCachedFieldMagnet)
+    return suite
+
+def kickmap_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestKickMap)
+    return suite
+
+def kickmap_cache_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestKickMapCache)
+    return suite
+
+def get_suite():
+    suite_list = []
+    suite_list.append(cached_field_magnet_suite())
+    suite_list.append(kickmap_suite())
+    suite_list.append(kickmap_cache_suite())
+    return unittest.TestSuite(suite_list)
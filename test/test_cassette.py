@@ -1,4 +1,5 @@
 
+import os
 import unittest
 import numpy
 import math
@@ -150,6 +151,14 @@ class TestSubVolume(unittest.TestCase):
         self.assertAlmostEqual(matrix[1][2], -get_Qyz(r, pos, dim), places=places)
         self.assertAlmostEqual(matrix[2][1], -get_Qyz(r, pos, dim), places=places)
 
+    def test_get_matrices(self):
+        subvolume = idpy.cassette.SubVolume([1,2,3], [4,5,6])
+        points = [[1,1,1], [0,-2,3], [6,8,10]]
+        matrices = subvolume.get_matrices(points)
+        self.assertEqual(matrices.shape, (3,3,3))
+        for point, matrix in zip(points, matrices):
+            numpy.testing.assert_array_equal(matrix, subvolume.get_matrix(point))
+
     def test_copy(self):
         dim = [1,2,3]
         pos = [4,5,6]
@@ -286,6 +295,30 @@ class TestBlock(unittest.TestCase):
             self.assertAlmostEqual(matrix[1][2], -Qyz, places=places)
             self.assertAlmostEqual(matrix[2][1], -Qyz, places=places)
 
+    def test_get_matrices(self):
+        block = idpy.cassette.Block([1,0,0], [1,2,3], [0,0,0])
+        points = [[1,1,2], [-2,0.5,0], [0.2,-3,4]]
+        matrices = block.get_matrices(points)
+        self.assertEqual(matrices.shape, (3,3,3))
+        for point, matrix in zip(points, matrices):
+            numpy.testing.assert_array_equal(matrix, block.get_matrix(point))
+
+    def test_demagnetization_tensor(self):
+        places = 14
+        dim = [1,2,3]
+        pos = [4,5,6]
+        functions = [[get_Qxx, get_Qxy, get_Qxz], [get_Qxy, get_Qyy, get_Qyz], [get_Qxz, get_Qyz, get_Qzz]]
+        points = numpy.random.default_rng(0).uniform(-3, 10, (50,3))
+        points = points[numpy.any(numpy.abs(points - pos) > numpy.array(dim)/2, axis=1)]
+        tensors = idpy.cassette.demagnetization_tensor(points, pos, dim)
+        for point, tensor in zip(points.tolist(), tensors):
+            for i in range(3):
+                for j in range(3):
+                    self.assertAlmostEqual(tensor[i][j], functions[i][j](point, pos, dim), places=places)
+        block = idpy.cassette.Block([1,0,0], dim, pos)
+        numpy.testing.assert_allclose(block.get_matrices(points), -tensors, atol=1e-14)
+
+
 class TestHalbachCassette(unittest.TestCase):
 
     def setUp(self):
@@ -644,6 +677,217 @@ class TestHalbachCassette(unittest.TestCase):
             self.assertAlmostEqual(field[1], By_radia[i], places=places)
             self.assertAlmostEqual(field[2], Bz_radia[i], places=places)
 
+    def test_periodic_mode(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_rectangle)
+        cassette.set_ycenter(0.08)
+        x = numpy.linspace(-0.01, 0.01, 5)
+        y = numpy.linspace(-0.01, 0.01, 5)
+        pos = [[0.002, -0.003, 0.1], [0.0, 0.0, 0.45], [-0.004, 0.005, -0.05], [0.0, 0.0, 5.0]]
+        exact = cassette.field(pos)
+        cassette.enable_periodic_mode(x, y, points_per_period=128)
+        field = cassette.field(pos)
+        for i in range(len(pos)):
+            for j in range(3):
+                self.assertAlmostEqual(field[i][j], exact[i][j], places=5)
+        cassette.disable_periodic_mode()
+        field = cassette.field(pos)
+        for i in range(len(pos)):
+            for j in range(3):
+                self.assertEqual(field[i][j], exact[i][j])
+
+    def test_far_field_approximation(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        pos = [[0.0, 0.08, 0.1], [0.04, 0.04, 0.3], [0.0, 0.1, -0.2]]
+        exact = cassette.field(pos)
+
+        cassette.enable_far_field_approximation(near_radius=10.0)
+        field = cassette.field(pos)
+        for i in range(len(pos)):
+            for j in range(3):
+                self.assertAlmostEqual(field[i][j], exact[i][j], places=12)
+
+        cassette.enable_far_field_approximation(near_radius=0.2, tolerance=1e-6)
+        report = cassette.far_field_report(pos)
+        self.assertEqual(report['nr_points'], len(pos))
+        self.assertEqual(report['nr_exact_pairs'] + report['nr_dipole_pairs'] + report['nr_dropped_pairs'], len(pos)*cassette.size)
+        self.assertLess(report['max_error'], 1e-6)
+
+        cassette.disable_far_field_approximation()
+        field = cassette.field(pos)
+        for i in range(len(pos)):
+            for j in range(3):
+                self.assertEqual(field[i][j], exact[i][j])
+
+    def test_field_integrals(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        cassette.set_ycenter(0.04)
+        x, y = [0.0, 0.005], [0.0, -0.002]
+        zmin, zmax = cassette.zmin - 0.3, cassette.zmax + 0.3
+        first, second = cassette.field_integrals(x, y, zmin, zmax, nrpts=2001)
+        z = numpy.linspace(zmin, zmax, 2001)
+        for i in range(2):
+            pos = numpy.column_stack([numpy.full(len(z), x[i]), numpy.full(len(z), y[i]), z])
+            field = cassette.field(pos)
+            cumulative = numpy.vstack([numpy.zeros(3), numpy.cumsum((field[1:] + field[:-1])/2*(z[1] - z[0]), axis=0)])
+            for j in range(3):
+                self.assertAlmostEqual(first[i][j], cumulative[-1][j], places=10)
+                self.assertAlmostEqual(second[i][j], numpy.sum((cumulative[1:,j] + cumulative[:-1,j])/2*(z[1] - z[0])), places=10)
+        grid_first, grid_second = cassette.field_integrals_grid(x, y, zmin, zmax, nrpts=2001)
+        self.assertEqual(grid_first.shape, (2, 2, 3))
+        for j in range(3):
+            self.assertAlmostEqual(grid_first[0][0][j], first[0][j], places=12)
+            self.assertAlmostEqual(grid_first[1][1][j], first[1][j], places=12)
+
+    def test_field_workers(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_rectangle)
+        pos = numpy.zeros((20000,3))
+        pos[:,0] = numpy.linspace(-0.01, 0.01, len(pos))
+        pos[:,1] = 0.05
+        pos[:,2] = numpy.linspace(-0.5, 0.5, len(pos))
+        serial = cassette.field(pos)
+        parallel = cassette.field(pos, workers=4)
+        self.assertTrue(numpy.array_equal(serial, parallel))
+
+    def test_field_workers_nested(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_rectangle)
+        pos = numpy.zeros((10000,3))
+        pos[:,1] = 0.05
+        pos[:,2] = numpy.linspace(-0.5, 0.5, len(pos))
+        shifts = [0.0, 0.01]
+        field = lambda magnet, dx: magnet.field(pos + [dx, 0, 0], workers=2)
+        nested = idpy.utils._fork_map(field, cassette, shifts, workers=2)
+        for dx, result in zip(shifts, nested):
+            self.assertTrue(numpy.array_equal(result, cassette.field(pos + [dx, 0, 0])))
+
+    def test_block_arrays(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_rectangle)
+        mag, dim, pos = cassette.get_block_arrays()
+        self.assertEqual(mag.shape, (cassette.size, 3))
+        for i in range(cassette.size):
+            block = cassette.get_item(i)
+            numpy.testing.assert_array_equal(mag[i], block.mag)
+            numpy.testing.assert_array_equal(dim[i], block.dim)
+            numpy.testing.assert_array_equal(pos[i], block.pos)
+        numpy.testing.assert_array_equal(cassette.magnetization_vector, mag)
+        errors = numpy.random.RandomState(0).normal(1.0, 0.01, (cassette.size, 1))
+        cassette.magnetizations = mag*errors
+        cassette.positions = pos + [0, 0.001, 0]
+        numpy.testing.assert_allclose(cassette.get_item(3).mag, mag[3]*errors[3])
+        numpy.testing.assert_allclose(cassette.get_item(3).pos, pos[3] + [0, 0.001, 0])
+        numpy.testing.assert_array_equal(cassette.dimensions, dim)
+        with self.assertRaises(idpy.cassette.CassetteException):
+            cassette.dimensions = dim[:2]
+
+    def test_magnetization_error_ensemble(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        ensemble = idpy.cassette.MagnetizationErrorEnsemble(cassette, 4, amplitude=0.01, angle=0.005, seed=7)
+        mag = cassette.magnetizations
+        instance = ensemble.instance(1)
+        numpy.testing.assert_array_equal(instance.magnetizations, ensemble.magnetizations(1)[0])
+        numpy.testing.assert_array_equal(cassette.magnetizations, mag)
+        ratio = numpy.linalg.norm(instance.magnetizations, axis=1)/numpy.linalg.norm(mag, axis=1)
+        self.assertLess(numpy.max(numpy.abs(ratio - 1)), 0.05)
+        self.assertFalse(numpy.array_equal(ensemble.magnetizations(0)[0], ensemble.magnetizations(1)[0]))
+        pos = [[0.0, 0.08, 0.1], [0.0, 0.08, 0.2]]
+        by = lambda magnet: magnet.field(pos)[:,1]
+        serial = dict(ensemble.evaluate(by))
+        parallel = dict(ensemble.evaluate(by, workers=2))
+        self.assertEqual(sorted(parallel), [0, 1, 2, 3])
+        for index in range(4):
+            numpy.testing.assert_array_equal(serial[index], parallel[index])
+            numpy.testing.assert_array_equal(serial[index], by(ensemble.instance(index)))
+
+    def test_magnetization_error_ensemble_response(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        pos = numpy.zeros((21,3))
+        pos[:,1] = 0.08
+        pos[:,2] = numpy.linspace(cassette.zmin - 0.1, cassette.zmax + 0.1, 21)
+        response = cassette.response_matrix(pos)
+        ensemble = idpy.cassette.MagnetizationErrorEnsemble(cassette, 2, amplitude=0.01, angle=0.005, seed=7)
+        instance = ensemble.instance(0)
+        self.assertIsNot(instance.response_matrix(pos), response)
+        numpy.testing.assert_allclose(instance.response_matrix(pos).field(), instance.field(pos), atol=1e-12)
+        self.assertFalse(numpy.allclose(instance.response_matrix(pos).field(), response.field(), atol=1e-12))
+
+    def test_response_matrix(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        pos = numpy.zeros((41,3))
+        pos[:,1] = 0.08
+        pos[:,2] = numpy.linspace(cassette.zmin - 0.1, cassette.zmax + 0.1, 41)
+        response = cassette.response_matrix(pos)
+        self.assertIs(cassette.response_matrix(pos), response)
+        self.assertEqual(response.shape, (3*len(pos), 3*cassette.size))
+        field = cassette.field(pos)
+        numpy.testing.assert_allclose(response.field(), field, atol=1e-12)
+        mag = cassette.magnetizations
+        dmag = numpy.random.default_rng(0).normal(0, 0.01, mag.shape)
+        cassette.magnetizations = mag + dmag
+        self.assertIs(cassette.response_matrix(pos), response)
+        numpy.testing.assert_allclose(response.dot(dmag), cassette.field(pos) - field, atol=1e-12)
+        first, second = response.field_integrals(dmag)
+        difference = cassette.field(pos) - field
+        integral = numpy.sum((difference[1:] + difference[:-1])/2*numpy.diff(pos[:,2])[:,None], axis=0)
+        numpy.testing.assert_allclose(first, integral, atol=1e-12)
+        compressed = idpy.cassette.ResponseMatrix(cassette, pos, tolerance=1e-6)
+        numpy.testing.assert_allclose(compressed.dot(dmag), response.dot(dmag), atol=1e-6*numpy.max(numpy.abs(field)))
+        copy = idpy.cassette.HalbachCassette.__new__(idpy.cassette.HalbachCassette)
+        copy.__dict__.update(cassette.__dict__)
+        copy._cppobj = idcpp.HalbachCassette(cassette._cppobj)
+        copy.magnetizations = mag
+        self.assertIsNot(copy.response_matrix(pos), response)
+        numpy.testing.assert_allclose(copy.response_matrix(pos).field(), field, atol=1e-12)
+        self.assertIs(cassette.response_matrix(pos), response)
+
+    def test_response_matrix_subvolumes(self):
+        chamfered = idpy.cassette.Block([0,1,0], [0.06,0.06,0.06], [0,0,0])
+        chamfered.add_subvolume(idpy.cassette.SubVolume([0.02,0.02,0.06], [0.02,0.02,0], -1))
+        block = idpy.cassette.Block([0,0,1], [0.06,0.06,0.06], [0,0,0.1])
+        container = idpy.cassette.BlockContainer([chamfered, block])
+        pos = numpy.zeros((21,3))
+        pos[:,1] = 0.05
+        pos[:,2] = numpy.linspace(-0.1, 0.2, 21)
+        pos[10] = [0.01, 0.0, 0.1]
+        response = container.response_matrix(pos)
+        numpy.testing.assert_allclose(response.field(), container.field(pos), atol=1e-12)
+        subvolume = idpy.cassette.SubVolume([0.02,0.02,0.06], [-0.02,0.02,0], -1)
+        container._cppobj.get_item(0).set_subvolume(0, subvolume._cppobj)
+        self.assertIsNot(container.response_matrix(pos), response)
+        numpy.testing.assert_allclose(container.response_matrix(pos).field(), container.field(pos), atol=1e-12)
+
+    def test_profile(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        pos = [[0.0, 0.08, 0.1], [0.04, 0.04, 0.3], [0.0, 0.1, -0.2]]
+        with idpy.profile() as profile:
+            cassette.field(pos)
+            cassette.field(pos[0])
+        report = profile.as_dict()
+        self.assertEqual(report['counters']['field_vector_calls'], 1)
+        self.assertEqual(report['counters']['field_calls'], 1)
+        self.assertEqual(report['counters']['field_points'], 4)
+        self.assertIn('cpp_field', report['timings'])
+        self.assertIn('conversion', report['timings'])
+        self.assertGreaterEqual(report['wall_time'], sum(report['timings'].values()))
+        self.assertIsNone(idpy.profiling._active)
+
+    def test_profile_workers(self):
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette_cube)
+        pos = numpy.zeros((10000,3))
+        pos[:,1] = 0.08
+        pos[:,2] = numpy.linspace(-0.2, 0.4, len(pos))
+        with idpy.profile() as profile:
+            cassette.field(pos, workers=2)
+        report = profile.as_dict()
+        self.assertEqual(report['counters']['field_points'], len(pos))
+        self.assertEqual(report['counters']['field_vector_calls'], len(report['workers']))
+        self.assertTrue(all(worker['pid'] != os.getpid() for worker in report['workers']))
+
+    def test_phase_error(self):
+        cassette = idpy.cassette.HalbachCassette(self.block_cube, idpy.utils.rotx90p, 10)
+        cassette.set_ycenter(0.04)
+        rms, poles, errors = cassette.phase_error(skip_periods=3)
+        self.assertEqual(len(poles), len(errors))
+        self.assertLess(rms, 0.5)
+
 
 def subvolume_suite():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestSubVolume)
@@ -0,0 +1,178 @@
+
+import os
+import tempfile
+import unittest
+import numpy
+import idcpp
+import idpy
+
+class TestFieldMapExport(unittest.TestCase):
+
+    def setUp(self):
+        block = idpy.cassette.Block([0, 1, 0], [0.06, 0.06, 0.01], [0, 0, 0])
+        self.cassette = idpy.cassette.HalbachCassette(block, idpy.utils.rotx90p, 3)
+        self.cassette.set_ycenter(0.04)
+        self.x = numpy.linspace(-0.004, 0.004, 5)
+        self.y = numpy.linspace(-0.002, 0.002, 3)
+        self.z = numpy.linspace(self.cassette.zmin, self.cassette.zmax, 25)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'fieldmap.npy')
+
+    def test_export_npy(self):
+        idpy.fieldmap.export_fieldmap(self.cassette, self.filename, self.x, self.y, self.z, slab_size=4)
+        fieldmap = idpy.fieldmap.FieldMap('export', self.filename)
+        self.assertAlmostEqual(fieldmap.z_min, self.z[0])
+        self.assertAlmostEqual(fieldmap.z_max, self.z[-1])
+        X, Y, Z = numpy.meshgrid(self.x, self.y, self.z, indexing='ij')
+        pos = numpy.column_stack([X.ravel(), Y.ravel(), Z.ravel()])
+        numpy.testing.assert_allclose(fieldmap.field(pos), self.cassette.field(pos), atol=1e-12)
+
+    def test_export_resume(self):
+        class Interrupted(Exception):
+            pass
+        cassette = self.cassette
+        class FailingMagnet(object):
+            nr_calls = 0
+            def field(self, pos):
+                FailingMagnet.nr_calls += 1
+                if FailingMagnet.nr_calls == 3:
+                    raise Interrupted()
+                return cassette.field(pos)
+        with self.assertRaises(Interrupted):
+            idpy.fieldmap.export_fieldmap(FailingMagnet(), self.filename, self.x, self.y, self.z, slab_size=4)
+        with self.assertRaises(idpy.fieldmap.FieldMapException):
+            idpy.fieldmap.FieldMap('export', self.filename)
+        idpy.fieldmap.export_fieldmap(FailingMagnet(), self.filename, self.x, self.y, self.z, slab_size=4)
+        self.assertEqual(FailingMagnet.nr_calls, 3 + 5)
+        fieldmap = idpy.fieldmap.FieldMap('export', self.filename)
+        pos = [0.001, 0.0005, 0.3*self.z[0] + 0.7*self.z[-1]]
+        numpy.testing.assert_allclose(fieldmap.field(pos), self.cassette.field(pos), atol=1e-3)
+
+    def test_export_overwrite_interrupted(self):
+        class Interrupted(Exception):
+            pass
+        class FailingMagnet(object):
+            def field(self, pos):
+                raise Interrupted()
+        idpy.fieldmap.export_fieldmap(self.cassette, self.filename, self.x, self.y, self.z, slab_size=4)
+        with self.assertRaises(Interrupted):
+            idpy.fieldmap.export_fieldmap(FailingMagnet(), self.filename, self.x, self.y, self.z, resume=False, slab_size=4)
+        with self.assertRaises(idpy.fieldmap.FieldMapException):
+            idpy.fieldmap.FieldMap('export', self.filename)
+        idpy.fieldmap.export_fieldmap(self.cassette, self.filename, self.x, self.y, self.z, slab_size=4)
+        pos = [0.001, 0.0005, self.z[12]]
+        numpy.testing.assert_allclose(idpy.fieldmap.FieldMap('export', self.filename).field(pos), self.cassette.field(pos), atol=1e-3)
+
+
+class TestFieldMapCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'fieldmap.dat')
+        self.x = numpy.linspace(-10, 10, 5)
+        self.z = numpy.linspace(-100, 100, 21)
+        with open(self.filename, 'w') as f:
+            f.write('X[mm]\tY[mm]\tZ[mm]\tBx\tBy\tBz\t[T]\n')
+            f.write('-'*80 + '\n')
+            for z in self.z:
+                for x in self.x:
+                    f.write('{0:+.6e}\t{1:+.6e}\t{2:+.6e}\t{3:+.6e}\t{4:+.6e}\t{5:+.6e}\n'.format(x, 0.0, z, 1e-3*x, numpy.sin(z/30), 1e-2*z))
+
+    def test_cache(self):
+        fieldmap = idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+        cache_filename = self.filename + '.cache.npy'
+        self.assertTrue(os.path.isfile(cache_filename))
+        self.assertAlmostEqual(fieldmap.x_min, -0.01)
+        self.assertAlmostEqual(fieldmap.z_max, 0.1)
+        numpy.testing.assert_allclose(fieldmap.field([0.005, 0.0, 0.03]), [0.005, numpy.sin(1.0), 0.3], atol=1e-6)
+        os.utime(cache_filename, (0, 0))
+        idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+        self.assertEqual(os.path.getmtime(cache_filename), 0)
+        with open(self.filename, 'a') as f:
+            f.write('\n')
+        idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+        self.assertNotEqual(os.path.getmtime(cache_filename), 0)
+
+    def test_cache_matches_container(self):
+        cached = idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+        fieldmap = idpy.fieldmap.FieldMap('text', self.filename)
+        pos = numpy.random.RandomState(0).uniform([-0.01, 0.0, -0.1], [0.01, 0.0, 0.1], (50,3))
+        numpy.testing.assert_allclose(cached.field(pos), fieldmap.field(pos), atol=1e-12)
+
+    def test_phase_error(self):
+        filename = os.path.join(os.path.dirname(self.filename), 'undulator.dat')
+        with open(filename, 'w') as f:
+            f.write('X[mm]\tY[mm]\tZ[mm]\tBx\tBy\tBz\t[T]\n')
+            f.write('-'*80 + '\n')
+            for z in numpy.linspace(-100, 100, 401):
+                for x in self.x:
+                    f.write('{0:+.6e}\t{1:+.6e}\t{2:+.6e}\t{3:+.6e}\t{4:+.6e}\t{5:+.6e}\n'.format(x, 0.0, z, 0.0, 0.5*numpy.sin(2*numpy.pi*z/20), 0.0))
+        fieldmap = idpy.fieldmap.FieldMap('undulator', filename, cache=True)
+        with self.assertRaises(idpy.fieldmap.FieldMapException):
+            fieldmap.phase_error()
+        rms, poles, errors = fieldmap.phase_error(0.0, 0.0, 0.02, skip_periods=1)
+        self.assertEqual(len(poles), len(errors))
+        self.assertLess(rms, 0.5)
+
+    def test_profile(self):
+        fieldmap = idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+        with idpy.profile() as profile:
+            fieldmap.field([[0.0, 0.0, 0.03], [0.005, 0.0, 0.0]])
+            fieldmap.field([0.0, 0.0, 0.0])
+        report = profile.as_dict()
+        self.assertEqual(report['counters']['field_vector_calls'], 1)
+        self.assertEqual(report['counters']['field_calls'], 1)
+        self.assertEqual(report['counters']['field_points'], 3)
+        self.assertIn('python_field', report['timings'])
+
+    def test_read_chunks(self):
+        x, y, z, field = idpy.fieldmap._read_fieldmap_text(self.filename)
+        chunks = idpy.fieldmap._read_fieldmap_text(self.filename, chunk_size=7)
+        for a, b in zip((x, y, z, field), chunks):
+            numpy.testing.assert_array_equal(a, b)
+
+    def test_read_only_directory(self):
+        directory = os.path.dirname(self.filename)
+        os.chmod(directory, 0o555)
+        try:
+            if os.access(directory, os.W_OK):
+                self.skipTest("directory is writable")
+            fieldmap = idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+            self.assertFalse(os.path.isfile(self.filename + '.cache.npy'))
+            numpy.testing.assert_allclose(fieldmap.field([0.005, 0.0, 0.03]), [0.005, numpy.sin(1.0), 0.3], atol=1e-6)
+        finally:
+            os.chmod(directory, 0o755)
+
+    def test_out_of_range(self):
+        fieldmap = idpy.fieldmap.FieldMap('cache', self.filename, cache=True)
+        pos = [[0.0, 0.0, 0.03], [0.0, 0.0, 0.2], [0.02, 0.0, 0.0]]
+        with self.assertRaises(idpy.fieldmap.FieldMapException):
+            fieldmap.field(pos)
+        field = fieldmap.field(pos, out_of_range='nan')
+        self.assertTrue(numpy.all(numpy.isnan(field[1:])))
+        numpy.testing.assert_allclose(field[0], fieldmap.field(pos[0]))
+        field = fieldmap.field(pos, out_of_range='zero')
+        numpy.testing.assert_array_equal(field[1:], numpy.zeros((2,3)))
+        fieldmap.out_of_range = 'clamp'
+        field = fieldmap.field(pos)
+        numpy.testing.assert_allclose(field[1], fieldmap.field([0.0, 0.0, 0.1]))
+        numpy.testing.assert_allclose(field[2], fieldmap.field([0.01, 0.0, 0.0]))
+        with self.assertRaises(idpy.fieldmap.FieldMapException):
+            fieldmap.out_of_range = 'extrapolate'
+
+
+def fieldmap_export_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFieldMapExport)
+    return suite
+
+def fieldmap_cache_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFieldMapCache)
+    return suite
+
+def get_suite():
+    suite_list = []
+    suite_list.append(fieldmap_export_suite())
+    suite_list.append(fieldmap_cache_suite())
+    return unittest.TestSuite(suite_list)
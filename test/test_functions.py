@@ -0,0 +1,88 @@
+import tempfile
+import unittest
+import numpy
+import idcpp
+import idpy
+
+class TestCalcKickmap(unittest.TestCase):
+
+    def setUp(self):
+        block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, 0.010], [0, 0, 0])
+        self.epu = idpy.idmodel.EPU(block, 2, 0.020, 0)
+        self.grid = idpy.auxiliary.Grid(3, 4, -0.002, 0.002, -0.001, 0.001)
+        self.zmin, self.zmax = self.epu.zmin - 0.05, self.epu.zmax + 0.05
+
+    def calc_kickmap(self, magnet, **kwargs):
+        return idpy.functions.calc_kickmap(magnet, 3e9, self.grid, self.zmin, self.zmax, 0.001, **kwargs)
+
+    def test_workers(self):
+        serial = self.calc_kickmap(self.epu)
+        parallel = self.calc_kickmap(self.epu, workers=2)
+        self.assertEqual(parallel.id_length, serial.id_length)
+        numpy.testing.assert_array_equal(parallel.x, serial.x)
+        numpy.testing.assert_array_equal(parallel.y, serial.y)
+        numpy.testing.assert_array_equal(parallel.kick_x, serial.kick_x)
+        numpy.testing.assert_array_equal(parallel.kick_y, serial.kick_y)
+
+    def test_cache(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = idpy.auxiliary.KickMapCache(directory.name)
+        miss = self.calc_kickmap(self.epu, cache=cache)
+        self.assertEqual(len(cache._entries()), 1)
+        hit = self.calc_kickmap(self.epu, cache=cache)
+        self.assertIs(type(hit), type(miss))
+        self.assertNotIsInstance(hit.kick_x, numpy.memmap)
+        numpy.testing.assert_array_equal(hit.kick_x, miss.kick_x)
+        numpy.testing.assert_array_equal(hit.kick_y, miss.kick_y)
+        self.epu.set_phase_csd(self.epu.phase_csd + 0.010)
+        moved = self.calc_kickmap(self.epu, cache=cache)
+        self.assertEqual(len(cache._entries()), 2)
+        numpy.testing.assert_array_equal(moved.kick_x, self.calc_kickmap(self.epu).kick_x)
+
+    def test_cache_key_subvolumes(self):
+        block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, 0.010], [0, 0, 0])
+        chamfered = idpy.cassette.Block(block=block)
+        chamfered.add_subvolume(idpy.cassette.SubVolume([0.010, 0.010, 0.010], [0.025, 0.025, 0], -1))
+        digests = [idpy.functions._magnet_digest(idpy.cassette.BlockContainer([b])) for b in (block, chamfered)]
+        self.assertNotEqual(digests[0], digests[1])
+
+    def test_cached_field_magnet(self):
+        x = numpy.linspace(-0.004, 0.004, 9)
+        y = numpy.linspace(-0.003, 0.003, 7)
+        z = numpy.arange(self.zmin - 0.002, self.zmax + 0.003, 0.0005)
+        cached = idpy.auxiliary.CachedFieldMagnet(self.epu, x, y, z)
+        exact = self.calc_kickmap(self.epu)
+        kickmap = self.calc_kickmap(cached)
+        self.assertEqual(kickmap.id_length, exact.id_length)
+        scale = numpy.max(numpy.abs(exact.kick_y))
+        numpy.testing.assert_allclose(kickmap.kick_x, exact.kick_x, atol=1e-3*scale)
+        numpy.testing.assert_allclose(kickmap.kick_y, exact.kick_y, atol=1e-3*scale)
+        parallel = self.calc_kickmap(cached, workers=2)
+        numpy.testing.assert_array_equal(parallel.kick_x, kickmap.kick_x)
+        numpy.testing.assert_array_equal(parallel.kick_y, kickmap.kick_y)
+
+
+class TestRungeKutta(unittest.TestCase):
+
+    def test_adaptive_zero_length_magnet(self):
+        block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, 0.0], [0, 0, 0])
+        self.assertEqual(block.zmin, block.zmax)
+        kick, nr_evaluations = idpy.functions.runge_kutta_adaptive(block, 3e9, [0, 0, -0.1], [0, 0, 1], 0.1)
+        numpy.testing.assert_allclose(kick, [0, 0, 0], atol=1e-12)
+        self.assertGreater(nr_evaluations, 0)
+
+
+def calckickmap_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCalcKickmap)
+    return suite
+
+def rungekutta_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRungeKutta)
+    return suite
+
+def get_suite():
+    suite_list = []
+    suite_list.append(calckickmap_suite())
+    suite_list.append(rungekutta_suite())
+    return unittest.TestSuite(suite_list)
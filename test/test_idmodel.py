@@ -0,0 +1,80 @@
+
+import unittest
+import numpy
+import idcpp
+import idpy
+
+class TestEPU(unittest.TestCase):
+
+    def setUp(self):
+        block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, 0.010], [0, 0, 0])
+        self.epu = idpy.idmodel.EPU(block, 4, 0.020, 0)
+        self.pos = numpy.zeros((11,3))
+        self.pos[:,2] = numpy.linspace(self.epu.zmin, self.epu.zmax, 11)
+
+    def test_magnetic_gap(self):
+        self.assertAlmostEqual(self.epu.magnetic_gap, 0.020)
+        self.epu.magnetic_gap = 0.030
+        self.assertAlmostEqual(self.epu.magnetic_gap, 0.030)
+        block = idpy.cassette.Block([0, 1.45, 0], [0.060, 0.060, 0.010], [0, 0, 0])
+        epu = idpy.idmodel.EPU(block, 4, 0.030, 0)
+        numpy.testing.assert_allclose(self.epu.field(self.pos), epu.field(self.pos), atol=1e-12)
+
+    def test_field_models_follow_cassettes(self):
+        x = numpy.linspace(-0.002, 0.002, 5)
+        pos = self.pos + [0.001, 0.0005, 0.0]
+        self.epu.enable_periodic_mode(x, x, points_per_period=128)
+        self.epu.set_phase_csd(self.epu.phase_csd + 0.010)
+        self.epu.set_phase_cie(self.epu.phase_cie - 0.005)
+        self.epu.magnetic_gap = 0.025
+        field = self.epu.field(pos)
+        self.epu.disable_periodic_mode()
+        numpy.testing.assert_allclose(field, self.epu.field(pos), atol=1e-5)
+        self.epu.enable_far_field_approximation(near_radius=0.05, tolerance=1e-6)
+        self.epu.set_phase_csd(self.epu.phase_csd - 0.010)
+        field = self.epu.field(pos)
+        self.epu.disable_far_field_approximation()
+        numpy.testing.assert_allclose(field, self.epu.field(pos), atol=1e-6)
+
+    def test_scan(self):
+        phase = self.epu.phase_csd
+        by = lambda magnet: {'by': magnet.field(self.pos)[:,1]}
+        table = self.epu.scan(by, gaps=[0.020, 0.025], phases_csd=[phase, phase + 0.010])
+        self.assertEqual(len(table), 4)
+        self.assertAlmostEqual(self.epu.magnetic_gap, 0.020)
+        for row in table:
+            self.epu.magnetic_gap = row.gap
+            self.epu.set_phase_csd(row.phase_csd)
+            numpy.testing.assert_allclose(row.by, self.epu.field(self.pos)[:,1], atol=1e-12)
+
+    def test_scan_workers(self):
+        phase = self.epu.phase_csd
+        by = lambda magnet: {'by': magnet.field(self.pos)[:,1]}
+        serial = self.epu.scan(by, gaps=[0.020, 0.025], phases_csd=[phase, phase + 0.010])
+        parallel = self.epu.scan(by, gaps=[0.020, 0.025], phases_csd=[phase, phase + 0.010], workers=2)
+        numpy.testing.assert_array_equal(parallel.gap, serial.gap)
+        numpy.testing.assert_array_equal(parallel.phase_csd, serial.phase_csd)
+        numpy.testing.assert_allclose(parallel.by, serial.by, atol=1e-12)
+
+    def test_scan_result_names(self):
+        with self.assertRaises(idpy.idmodel.IDModelException):
+            self.epu.scan(lambda magnet: {'gap': 0.0}, gaps=[0.020])
+
+    def test_scan_field_grid(self):
+        phase = self.epu.phase_csd
+        by = lambda magnet: {'by': magnet.field(self.pos)[:,1]}
+        x = numpy.linspace(-0.002, 0.002, 5)
+        z = numpy.linspace(self.epu.zmin - 0.01, self.epu.zmax + 0.01, 301)
+        exact = self.epu.scan(by, gaps=[0.020, 0.025], phases_csd=[phase, phase + 0.010])
+        table = self.epu.scan(by, gaps=[0.020, 0.025], phases_csd=[phase, phase + 0.010], field_grid=(x, x, z))
+        numpy.testing.assert_allclose(table.by, exact.by, atol=1e-4)
+
+
+def epu_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestEPU)
+    return suite
+
+def get_suite():
+    suite_list = []
+    suite_list.append(epu_suite())
+    return unittest.TestSuite(suite_list)
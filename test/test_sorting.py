@@ -0,0 +1,69 @@
+import unittest
+import numpy
+import idcpp
+import idpy
+
+class TestBlockSorter(unittest.TestCase):
+
+    def setUp(self):
+        block = idpy.cassette.Block([0, 1.45, 0], [0.020, 0.020, 0.005], [0, 0, 0])
+        self.cassette = idpy.cassette.HalbachCassette(block, idpy.utils.rotx90p, 3)
+        self.cassette.set_ycenter(0.020)
+        rng = numpy.random.default_rng(0)
+        nr_blocks = self.cassette.size + 2
+        self.blocks = numpy.zeros((nr_blocks, 3))
+        self.blocks[:,:2] = rng.normal(0, 0.03, (nr_blocks, 2))
+        self.blocks[:,2] = 1.45*(1 + rng.normal(0, 0.02, nr_blocks))
+        z = numpy.linspace(self.cassette.zmin - 0.02, self.cassette.zmax + 0.02, 41)
+        self.pos = numpy.zeros((len(z),3))
+        self.pos[:,2] = z
+        self.sorter = idpy.sorting.BlockSorter(self.cassette, self.blocks, self.pos)
+
+    def test_cost(self):
+        assignment = numpy.arange(len(self.blocks))
+        target = self.cassette.field(self.pos)
+        cassette = idpy.cassette.HalbachCassette(halbachcassette=self.cassette)
+        self.sorter.apply(assignment, cassette)
+        residue = cassette.field(self.pos) - target
+        self.assertAlmostEqual(self.sorter.cost(assignment)/numpy.sum(residue**2), 1, places=6)
+
+    def test_anneal(self):
+        assignment = numpy.arange(len(self.blocks))
+        best, cost = self.sorter.anneal(5000, seed=1, initial=assignment)
+        self.assertLess(cost, self.sorter.cost(assignment))
+        self.assertEqual(sorted(best), list(range(len(self.blocks))))
+        self.assertAlmostEqual(cost, self.sorter.cost(best))
+
+    def test_optimize_workers(self):
+        serial = self.sorter.optimize(2000, nr_chains=3, seed=2)
+        parallel = self.sorter.optimize(2000, nr_chains=3, seed=2, workers=3)
+        numpy.testing.assert_array_equal(serial[0], parallel[0])
+        self.assertAlmostEqual(serial[1], parallel[1])
+
+    def test_block_frame(self):
+        blocks = numpy.tile([0.1, 0.0, 1.45], (self.cassette.size, 1))
+        sorter = idpy.sorting.BlockSorter(self.cassette, blocks, self.pos)
+        mag = sorter.magnetizations(numpy.arange(self.cassette.size))
+        numpy.testing.assert_allclose(mag, self.cassette.magnetizations + [0.1, 0.0, 0.0], atol=1e-12)
+        rotation = idpy.sorting._slot_rotations(numpy.array([[-2.0, 0.0, 0.0]]))[0]
+        numpy.testing.assert_allclose(rotation, [[0, 0, -1], [1, 0, 0], [0, -1, 0]], atol=1e-12)
+
+    def test_integral_operator(self):
+        z = self.pos[:,2]
+        operator = idpy.sorting.integral_operator(z)
+        field = numpy.zeros((len(z), 3))
+        field[:,1] = numpy.cos(z/0.01)
+        first = numpy.concatenate([[0], numpy.cumsum((field[1:,1] + field[:-1,1])/2*numpy.diff(z))])
+        result = operator.dot(field.ravel())
+        self.assertAlmostEqual(result[1], first[-1])
+        self.assertAlmostEqual(result[4], numpy.sum((first[1:] + first[:-1])/2*numpy.diff(z)))
+
+
+def blocksorter_suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBlockSorter)
+    return suite
+
+def get_suite():
+    suite_list = []
+    suite_list.append(blocksorter_suite())
+    return unittest.TestSuite(suite_list)
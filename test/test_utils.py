@@ -130,6 +130,24 @@ class TestUtils(unittest.TestCase):
             for j in range(len(matrix[0])):
                 self.assertEqual(matrix[i][j], new_matrix[i][j])
 
+    def test_CppVectorVector3D_to_matrix_output_array(self):
+        matrix = numpy.array([[9.5928364,5.383864352,0], [3.258262,6.82743673,1.204784]])
+        CppVectorVector3D = idpy.utils._matrix_to_CppVectorVector3D(matrix)
+        out = numpy.zeros((2,3))
+        new_matrix = idpy.utils._CppVectorVector3D_to_matrix(CppVectorVector3D, out=out)
+        self.assertIs(new_matrix, out)
+        self.assertTrue(numpy.array_equal(matrix, out))
+
+        with self.assertRaises(idpy.utils.UtilsException):
+            idpy.utils._CppVectorVector3D_to_matrix(CppVectorVector3D, out=numpy.zeros((3,3)))
+
+    def test_CppDoubleVector_to_vector(self):
+        vector = [9.5928364,5.383864352,0]
+        CppDoubleVector = idcpp.CppDoubleVector(vector)
+        new_vector = idpy.utils._CppDoubleVector_to_vector(CppDoubleVector)
+        self.assertIsInstance(new_vector, numpy.ndarray)
+        self.assertTrue(numpy.array_equal(vector, new_vector))
+
     def test_CppMatrix3D_to_matrix(self):
         vector = [9.5928364,5.383864352,0]
         matrix = [vector, vector, vector]
@@ -185,6 +203,34 @@ class TestUtils(unittest.TestCase):
         self.assertAlmostEqual(m[2][1], 0)
         self.assertAlmostEqual(m[2][2], 1)
 
+    def test_fork_map(self):
+        args_list = [[1,2,3], [4,5], [6]]
+        serial = idpy.utils._fork_map(_sum_with_offset, 10, args_list)
+        parallel = idpy.utils._fork_map(_sum_with_offset, 10, args_list, workers=2)
+        self.assertEqual(serial, [16, 19, 16])
+        self.assertEqual(parallel, serial)
+
+    def test_fork_imap(self):
+        args_list = [[1,2,3], [4,5], [6]]
+        serial = list(idpy.utils._fork_imap(_sum_with_offset, 10, args_list))
+        parallel = list(idpy.utils._fork_imap(_sum_with_offset, 10, args_list, workers=2))
+        self.assertEqual(serial, [16, 19, 16])
+        self.assertEqual(sorted(parallel), sorted(serial))
+
+    def test_fork_map_nested(self):
+        args_list = [[1,2,3], [4,5], [6]]
+        serial = idpy.utils._fork_map(_nested_sum, 10, args_list)
+        parallel = idpy.utils._fork_map(_nested_sum, 10, args_list, workers=2)
+        self.assertEqual(serial, [36, 29, 16])
+        self.assertEqual(parallel, serial)
+
+
+def _sum_with_offset(offset, values):
+    return offset + sum(values)
+
+def _nested_sum(offset, values):
+    return sum(idpy.utils._fork_map(_sum_with_offset, offset, [[v] for v in values], workers=2))
+
 
 def utils_suite():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestUtils)